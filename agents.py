@@ -0,0 +1,50 @@
+"""In-process agents.
+
+An agent is any object with a ``decide(state)`` method that gets the state
+a client would receive and returns the keys to send (a string, possibly
+several keys, or a list). Agents are referred to by ``module:name``, where
+name is such an object, a class whose instances are agents, or a function
+taking the state. Classes taking a ``seed`` argument get the game's seed, so
+games can be played again.
+"""
+import importlib
+import inspect
+import random
+
+
+class FunctionAgent:
+    """Adapt a function taking the state into an agent."""
+
+    def __init__(self, function):
+        self.decide = function
+
+
+def load_agent(spec, seed=None):
+    """Load a new agent from its "module:name" reference, seeded if possible."""
+    module_name, _, name = spec.partition(":")
+    if not name:
+        raise ValueError(f"agent must be given as module:name, not {spec!r}")
+    agent = getattr(importlib.import_module(module_name), name)
+    if isinstance(agent, type):
+        if seed is not None and "seed" in inspect.signature(agent).parameters:
+            agent = agent(seed=seed)
+        else:
+            agent = agent()
+    if not hasattr(agent, "decide"):
+        agent = FunctionAgent(agent)
+    return agent
+
+
+def drop(state):
+    """Baseline agent, drops every piece where it spawns."""
+    return "s" if state["piece"] else ""
+
+
+class RandomAgent:
+    """Baseline agent, presses random keys."""
+
+    def __init__(self, seed=None):
+        self._rng = random.Random(seed)
+
+    def decide(self, state):
+        return self._rng.choice(["", "w", "a", "d", "s"])
@@ -0,0 +1,335 @@
+"""Replay archives, many recorded games in one file.
+
+    header     magic, version, keyframe interval
+    games      for each game, its replay (see replay.py) then its keyframes
+    index      one entry per game: offsets, score, lines, ticks, seed,
+               timestamp, player
+    footer     index offset, number of games, magic
+
+Keyframes hold the state of the game every `interval` ticks, so a game can
+be opened at any tick by simulating at most `interval` ticks. Archives are
+read through mmap. Games are added to a copy that replaces the archive once
+its index is written, so an interrupted pack leaves the archive as it was.
+
+    $ python3 archive.py pack games.archive replays/*.replay
+    $ python3 archive.py list games.archive
+    $ python3 archive.py show games.archive 0 1200
+"""
+import argparse
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from collections import namedtuple
+
+from game import Game, Snapshot
+import replay
+from replay import SequenceRandom
+from shape import KINDS
+
+MAGIC = b"TRAR"
+VERSION = 1
+INTERVAL = 256  # ticks between keyframes
+
+HEADER = struct.Struct("<4sBI")  # magic, version, keyframe interval
+FOOTER = struct.Struct("<QI4s")  # index offset, games, magic
+ENTRY = struct.Struct("<QIQIIIIQdB")  # see Entry, then the player name
+KEYFRAME = struct.Struct("<IIIIHHBBBbb")  # tick, drawn, score, lines, speed,
+# game speed, running, piece kind (255 for none), rotation, x, y; then the next
+# pieces and the rows
+NO_PIECE = 255
+
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+Entry = namedtuple(
+    "Entry",
+    [
+        "offset",  # of the replay
+        "length",  # of the replay
+        "keyframes",  # offset of the first keyframe
+        "count",  # keyframes
+        "score",
+        "lines",
+        "ticks",
+        "seed",
+        "timestamp",
+        "player",
+    ],
+)
+
+
+def keyframe_size(game):
+    return KEYFRAME.size + len(game.next_pieces) + 4 * game.dimensions.y
+
+
+def pack_keyframe(tick, drawn, snapshot):
+    """Encode the state of a game after tick ticks, with drawn pieces dealt."""
+    kind, rotation, x, y = snapshot.piece or (None, 0, 0, 0)
+    out = bytearray(
+        KEYFRAME.pack(
+            tick,
+            drawn,
+            snapshot.score,
+            snapshot.lines,
+            snapshot.speed,
+            snapshot.game_speed,
+            snapshot.running,
+            KIND_CODES[kind] if kind else NO_PIECE,
+            rotation,
+            x,
+            y,
+        )
+    )
+    out += bytes(KIND_CODES[kind] for kind in snapshot.next_pieces)
+    out += struct.pack(f"<{len(snapshot.board)}I", *snapshot.board)
+    return out
+
+
+def unpack_keyframe(data, offset, next_count, height):
+    """Decode a keyframe, return its tick, pieces dealt and Snapshot."""
+    (
+        tick,
+        drawn,
+        score,
+        lines,
+        speed,
+        game_speed,
+        running,
+        kind,
+        rotation,
+        x,
+        y,
+    ) = KEYFRAME.unpack_from(data, offset)
+    offset += KEYFRAME.size
+    next_pieces = tuple(KINDS[code] for code in data[offset : offset + next_count])
+    board = struct.unpack_from(f"<{height}I", data, offset + next_count)
+    piece = (KINDS[kind], rotation, x, y) if kind != NO_PIECE else None
+    snapshot = Snapshot(
+        board, piece, next_pieces, score, lines, speed, game_speed, bool(running)
+    )
+    return tick, drawn, snapshot
+
+
+def read_index(data):
+    """Keyframe interval and index entries of an archive."""
+    magic, version, interval = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not an archive, or an unsupported version")
+    offset, count, magic = FOOTER.unpack_from(data, len(data) - FOOTER.size)
+    if magic != MAGIC:
+        raise ValueError("archive index is missing")
+
+    index = []
+    for _ in range(count):
+        fields = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        size = fields[-1]
+        player = bytes(data[offset : offset + size]).decode("utf-8")
+        offset += size
+        index.append(Entry(*fields[:-1], player))
+    return interval, index
+
+
+class ArchiveWriter:
+    """Add games to an archive, creating it if needed.
+
+    Games are written to a copy of the archive, which replaces it on close()
+    and is thrown away if the writer is left on an exception."""
+
+    def __init__(self, path, interval=INTERVAL):
+        self.path = path
+        self.index = []
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, self._tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        self._file = os.fdopen(fd, "w+b")
+        try:
+            if os.path.exists(path) and os.path.getsize(path):
+                with open(path, "rb") as infile:
+                    data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+                    with data:
+                        self.interval, self.index = read_index(data)
+                        end = FOOTER.unpack_from(data, len(data) - FOOTER.size)[0]
+                    infile.seek(0)
+                    shutil.copyfileobj(infile, self._file)
+                self._file.truncate(end)  # the index is written again on close
+                self._file.seek(end)
+            else:
+                self.interval = interval
+                self._file.write(HEADER.pack(MAGIC, VERSION, interval))
+        except BaseException:
+            self.discard()
+            raise
+
+    def add(self, data):
+        """Add a recorded game, from the contents of its replay file."""
+        game_replay = replay.parse(data)
+        rng = SequenceRandom(game_replay.pieces)
+        game = Game(game_replay.width, game_replay.height, rng=rng)
+
+        keyframes = bytearray()
+        for tick, keys in enumerate(game_replay.ticks):
+            if tick % self.interval == 0:
+                keyframes += pack_keyframe(tick, rng.drawn, game.snapshot())
+            game.step(keys)
+
+        offset = self._file.tell()
+        self._file.write(data)
+        self._file.write(keyframes)
+        self.index.append(
+            Entry(
+                offset,
+                len(data),
+                offset + len(data),
+                len(keyframes) // keyframe_size(game),
+                game.score,
+                game.lines,
+                len(game_replay.ticks),
+                game_replay.seed,
+                game_replay.timestamp,
+                game_replay.player,
+            )
+        )
+        return game
+
+    def close(self):
+        """Write the index and replace the archive."""
+        try:
+            offset = self._file.tell()
+            for entry in self.index:
+                name = entry.player.encode("utf-8")[:255]
+                self._file.write(ENTRY.pack(*entry[:-1], len(name)))
+                self._file.write(name)
+            self._file.write(FOOTER.pack(offset, len(self.index), MAGIC))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(self._tmp, self.path)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        """Leave the archive as it was, dropping the games added."""
+        self._file.close()
+        os.unlink(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class Archive:
+    """Read only, memory mapped access to an archive.
+
+    index holds an Entry per game, e.g. to pick the best games:
+
+        with Archive(path) as archive:
+            best = max(range(len(archive)), key=lambda i: archive[i].score)
+            game, game_replay = archive.seek(best, 1000)
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.interval, self.index = read_index(self._data)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, game):
+        return self.index[game]
+
+    def raw(self, game):
+        """The replay file of a game."""
+        entry = self.index[game]
+        return self._data[entry.offset : entry.offset + entry.length]
+
+    def replay(self, game):
+        """The decoded replay of a game."""
+        entry = self.index[game]
+        with memoryview(self._data) as view:
+            return replay.parse(view[entry.offset : entry.offset + entry.length])
+
+    def seek(self, game, tick=0):
+        """A game as it was after tick ticks, and its replay to carry on."""
+        entry = self.index[game]
+        game_replay = self.replay(game)
+        tick = max(0, min(tick, entry.ticks))
+
+        rng = SequenceRandom(game_replay.pieces)
+        result = Game(game_replay.width, game_replay.height, rng=rng)
+        start = 0
+        if entry.count:
+            frame = min(tick // self.interval, entry.count - 1)
+            start, drawn, snapshot = unpack_keyframe(
+                self._data,
+                entry.keyframes + frame * keyframe_size(result),
+                len(result.next_pieces),
+                game_replay.height,
+            )
+            result.restore(snapshot, SequenceRandom(game_replay.pieces[drawn:]))
+
+        for keys in game_replay.ticks[start:tick]:
+            result.step(keys)
+        return result, game_replay
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack = commands.add_parser("pack", help="add replay files to an archive")
+    pack.add_argument("archive")
+    pack.add_argument("replays", nargs="+")
+    pack.add_argument(
+        "--interval", help="ticks between keyframes", type=int, default=INTERVAL
+    )
+    listing = commands.add_parser("list", help="games in an archive, best first")
+    listing.add_argument("archive")
+    show = commands.add_parser("show", help="print a game at a given tick")
+    show.add_argument("archive")
+    show.add_argument("game", type=int)
+    show.add_argument("tick", type=int)
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        with ArchiveWriter(args.archive, args.interval) as writer:
+            for path in args.replays:
+                with open(path, "rb") as infile:
+                    game = writer.add(infile.read())
+                print(path, game.score)
+
+    if args.command == "list":
+        with Archive(args.archive) as archive:
+            ranked = sorted(range(len(archive)), key=lambda i: -archive[i].score)
+            for i in ranked:
+                entry = archive[i]
+                print(i, entry.player, entry.score, entry.lines, entry.ticks, entry.seed)
+
+    if args.command == "show":
+        with Archive(args.archive) as archive:
+            game, _ = archive.seek(args.game, args.tick)
+            piece = set(game.current_piece.positions) if game.current_piece else ()
+            for y, row in enumerate(game.board[:-1]):
+                print(
+                    "".join(
+                        "#" if row >> x & 1 else "@" if (x, y) in piece else "."
+                        for x in range(game.dimensions.x)
+                    )
+                )
+            print("score", game.score, "lines", game.lines)
@@ -0,0 +1,188 @@
+"""Many games stepped together with NumPy, for large scale agent evaluation.
+
+BatchGames holds N independent games as arrays and advances all of them with
+a single step(actions) call, following the same rules as Game.step(): the
+same spawn position and rotation, gravity before the key, rotation and
+shifts undone when blocked, lines ** 2 scoring and speed increasing every
+SPEED_STEP points. Game i draws its pieces from random.Random(seeds[i]), so
+Game(rng=random.Random(seeds[i])) fed the same keys plays the same game.
+Finished games are recorded in ``results`` and restarted with a new seed.
+"""
+import random
+from collections import namedtuple
+
+import numpy as np
+
+from game import GAME_SPEED, SPEED_STEP
+from shape import KINDS, ROTATIONS, Shape
+
+KEYS = ("", "w", "a", "d", "s")  # action codes: 0 nothing, 1 rotate, 2 left, 3 right, 4 drop
+NOOP, ROTATE, LEFT, RIGHT, DROP = range(len(KEYS))
+
+Result = namedtuple("Result", ["slot", "seed", "score", "lines", "ticks"])
+
+# cell offsets of every (kind, rotation), rotations padded by repeating them
+N_ROTATIONS = np.array([len(ROTATIONS[kind]) for kind in KINDS])
+OFFSETS = np.array(
+    [
+        [ROTATIONS[kind][rotation % len(ROTATIONS[kind])].cells for rotation in range(4)]
+        for kind in KINDS
+    ]
+)
+SPAWN_ROTATION = np.array([Shape(kind).rotation for kind in KINDS])
+PIECES = range(len(KINDS))  # rng.choice(PIECES) draws the index of rng.choice(KINDS)
+
+
+class BatchGames:
+    """N games stepped in lockstep."""
+
+    def __init__(self, n, x=10, y=30, seed=None, seeds=None):
+        self.n = n
+        self.dimensions = (x, y)
+        self._seeds = random.Random(seed)  # seeds for games started after these
+        seeds = list(seeds) if seeds is not None else []
+        seeds += [self._seeds.getrandbits(32) for _ in range(n - len(seeds))]
+
+        self._empty_row = 1 | 1 << (x - 1)
+        self._full_row = (1 << x) - 1
+        self._spawn_x = (x - Shape.dimensions.x) // 2
+
+        self.boards = np.empty((n, y + 1), dtype=np.uint32)  # row masks, as Game.board
+        self.kind = np.zeros(n, dtype=np.int64)
+        self.rotation = np.zeros(n, dtype=np.int64)
+        self.x = np.zeros(n, dtype=np.int64)
+        self.y = np.zeros(n, dtype=np.int64)
+        self.has_piece = np.zeros(n, dtype=bool)
+        self.next_pieces = np.zeros((n, 3), dtype=np.int64)
+        self.score = np.zeros(n, dtype=np.int64)
+        self.lines = np.zeros(n, dtype=np.int64)
+        self.game_speed = np.zeros(n, dtype=np.int64)
+        self.ticks = np.zeros(n, dtype=np.int64)
+        self.seeds = np.zeros(n, dtype=np.int64)
+        self.rngs = [None] * n
+        self.results = []  # Result of every finished game
+
+        for slot in range(n):
+            self.reset(slot, seeds[slot])
+
+    def reset(self, slot, seed=None):
+        """Start a new game in a slot."""
+        if seed is None:
+            seed = self._seeds.getrandbits(32)
+        rng = random.Random(seed)
+        self.rngs[slot] = rng
+        self.seeds[slot] = seed
+        self.boards[slot, :-1] = self._empty_row
+        self.boards[slot, -1] = self._full_row
+        self.next_pieces[slot] = [rng.choice(PIECES) for _ in range(3)]
+        self.has_piece[slot] = False
+        self.score[slot] = self.lines[slot] = self.ticks[slot] = 0
+        self.game_speed[slot] = GAME_SPEED
+
+    def fits(self, idx, kind, rotation, x, y):
+        """Whether pieces of games idx are free at the given positions."""
+        cells = OFFSETS[kind, rotation]
+        cx = x[:, None] + cells[:, :, 0]
+        cy = y[:, None] + cells[:, :, 1]
+        width, height = self.dimensions
+        inside = (cx >= 0) & (cx < width) & (cy <= height)
+        rows = self.boards[idx[:, None], np.clip(cy, 0, height)]
+        taken = (rows >> np.clip(cx, 0, width - 1).astype(np.uint32)) & 1
+        return (inside & ((cy < 0) | (taken == 0))).all(axis=1)
+
+    def cells(self, idx=slice(None)):
+        """(N, 4, 2) cells of the falling pieces, meaningful where has_piece."""
+        cells = OFFSETS[self.kind[idx], self.rotation[idx]]
+        return cells + np.stack([self.x[idx], self.y[idx]], axis=1)[:, None, :]
+
+    def step(self, actions):
+        """Advance every game one tick, with one action code (see KEYS) each.
+
+        Returns the score gained by every game and which games ended, those
+        are restarted right away."""
+        actions = np.asarray(actions)
+        everyone = np.arange(self.n)
+        before = self.score.copy()
+        over = np.zeros(self.n, dtype=bool)
+
+        spawn = everyone[~self.has_piece]
+        if len(spawn):
+            self.kind[spawn] = self.next_pieces[spawn, 0]
+            self.next_pieces[spawn, :-1] = self.next_pieces[spawn, 1:]
+            rngs = self.rngs
+            self.next_pieces[spawn, -1] = [rngs[slot].choice(PIECES) for slot in spawn]
+            self.rotation[spawn] = SPAWN_ROTATION[self.kind[spawn]]
+            self.x[spawn] = self._spawn_x
+            self.y[spawn] = 0
+            self.has_piece[spawn] = True
+            over[spawn] = ~self.fits(
+                spawn, self.kind[spawn], self.rotation[spawn], self.x[spawn], self.y[spawn]
+            )
+
+        self.y += 1
+        free = self.fits(everyone, self.kind, self.rotation, self.x, self.y)
+
+        idx = everyone[free & (actions == ROTATE)]
+        if len(idx):
+            turned = (self.rotation[idx] + 1) % N_ROTATIONS[self.kind[idx]]
+            ok = self.fits(idx, self.kind[idx], turned, self.x[idx], self.y[idx])
+            self.rotation[idx[ok]] = turned[ok]
+
+        for action, shift in ((LEFT, -1), (RIGHT, 1)):
+            idx = everyone[free & (actions == action)]
+            if len(idx):
+                moved = self.x[idx] + shift
+                ok = self.fits(idx, self.kind[idx], self.rotation[idx], moved, self.y[idx])
+                self.x[idx[ok]] = moved[ok]
+
+        idx = everyone[free & (actions == DROP)]
+        while len(idx):
+            below = self.y[idx] + 1
+            ok = self.fits(idx, self.kind[idx], self.rotation[idx], self.x[idx], below)
+            idx = idx[ok]
+            self.y[idx] += 1
+
+        locking = everyone[~free]
+        if len(locking):
+            self.y[locking] -= 1
+            self.lock(locking)
+
+        self.ticks += 1
+        done = everyone[over]
+        for slot in done:
+            self.results.append(
+                Result(
+                    slot,
+                    int(self.seeds[slot]),
+                    int(self.score[slot]),
+                    int(self.lines[slot]),
+                    int(self.ticks[slot]),
+                )
+            )
+        gained = self.score - before
+        for slot in done:
+            self.reset(slot)
+        return gained, over
+
+    def lock(self, idx):
+        """Lock the pieces of games idx and clear full rows."""
+        height = self.dimensions[1]
+        cells = self.cells(idx)
+        bits = np.left_shift(np.uint32(1), cells[:, :, 0].astype(np.uint32))
+        rows = (np.repeat(idx, cells.shape[1]), cells[:, :, 1].ravel())
+        np.bitwise_or.at(self.boards, rows, bits.ravel())
+        self.has_piece[idx] = False
+
+        rows = self.boards[idx, :height]
+        full = rows == self._full_row
+        lines = full.sum(axis=1)
+        cleared = lines > 0
+        if cleared.any():
+            idx, rows, full, lines = idx[cleared], rows[cleared], full[cleared], lines[cleared]
+            order = np.argsort(~full, axis=1, kind="stable")  # full rows first, others in order
+            rows = np.take_along_axis(rows, order, axis=1)
+            rows[np.arange(height) < lines[:, None]] = self._empty_row
+            self.boards[idx, :height] = rows
+            self.lines[idx] += lines
+            self.score[idx] += lines ** 2
+            self.game_speed[idx] = GAME_SPEED + self.score[idx] // SPEED_STEP
@@ -0,0 +1,362 @@
+"""Benchmarks of the game engine, the protocol and the server.
+
+Results are written as JSON, time per operation and operations per second
+for each benchmark, and can be compared with a previous run:
+
+    $ python3 bench.py --output before.json
+    $ python3 bench.py --output after.json --compare before.json
+
+Everything runs locally, the server benchmark over loopback websockets, its
+game played by a house bot and by a player client in each encoding.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from agents import RandomAgent
+from game import Game
+from protocol import DeltaDecoder, Frames, decode
+from shape import KINDS, Shape
+
+logger = logging.getLogger("Bench")
+logger.setLevel(logging.INFO)
+
+STACKS = {"empty": 0, "mid": 12, "tall": 24}  # rows filled, of 30
+SEEDS = range(1, 21)
+GROUPS = ["engine", "protocol", "games", "server"]
+
+
+def measure(function, number, repeat=5):
+    """Best time of calling function number times, per call."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return best / number
+
+
+def measure_prepared(prepare, function, number, repeat=5):
+    """Best time of function called on number objects from prepare, per call.
+
+    Objects are prepared before the clock starts, for functions that change
+    what they run on."""
+    best = float("inf")
+    for _ in range(repeat):
+        items = [prepare() for _ in range(number)]
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return best / number
+
+
+def result(per_op, unit="op"):
+    return {"unit": unit, "seconds": per_op, "per_second": 1 / per_op}
+
+
+def stacked(height, full=0, seed=0):
+    """A game whose board is filled up to height rows, each with one hole,
+    the lowest full rows with no hole."""
+    game = Game(rng=random.Random(seed))
+    x, y = game.dimensions
+    rng = random.Random(seed)
+    inner = (1 << x) - 1
+    rows = [1 | 1 << (x - 1)] * (y - height)
+    rows += [inner & ~(1 << rng.randrange(1, x - 1)) for _ in range(height - full)]
+    rows += [inner] * full
+    snapshot = game.snapshot()._replace(board=tuple(rows), piece=None)
+    game.restore(snapshot)
+    return game, snapshot
+
+
+def bench_engine(number):
+    results = {}
+    for name, height in STACKS.items():
+        game, snapshot = stacked(height)
+        pieces = []
+        for kind in KINDS:
+            for x in range(-1, game.dimensions.x - 3):
+                piece = Shape(kind)
+                piece.set_pos(x, game.dimensions.y - height - 4)
+                pieces.append(piece)
+
+        def valid():
+            for piece in pieces:
+                game.valid(piece)
+
+        results[f"valid/{name}"] = result(measure(valid, number // 10) / len(pieces))
+
+        results[f"clear_rows/{name}"] = result(measure(game.clear_rows, number))
+
+        def spawn():
+            game.restore(snapshot)
+            game.step()
+
+        results[f"spawn/{name}"] = result(measure(spawn, number // 10))
+
+        if height >= 4:
+            _, full_snapshot = stacked(height, full=4)
+
+            def full_game():
+                full = Game(rng=random.Random(0))
+                full.restore(full_snapshot)
+                return full
+
+            results[f"clear_rows_4/{name}"] = result(
+                measure_prepared(full_game, Game.clear_rows, number // 10)
+            )
+
+    piece = Shape("T")
+    results["shape/rotate"] = result(measure(piece.rotate, number))
+    results["shape/set_pos"] = result(measure(lambda: piece.set_pos(3, 5), number))
+    return results
+
+
+def bench_protocol(number):
+    results = {}
+    for name, height in STACKS.items():
+        game, _ = stacked(height)
+        state = game.step()
+        state["player"] = "bench"
+        for encoding in ("json", "binary"):
+            for kind, delta, keyframe in [
+                ("full", False, False),
+                ("key", True, True),
+                ("delta", True, False),
+            ]:
+                if encoding == "binary" and kind == "full":
+                    continue
+
+                def encode():
+                    frames = Frames(state, 1, keyframe, game)
+                    return frames.get(delta, keyframe, encoding)
+
+                message = encode()
+                key = Frames(state, 1, True, game).get(True, True, encoding)
+
+                def decode_message():  # deltas after their keyframe
+                    decoder = DeltaDecoder()
+                    if kind == "delta":
+                        decoder.decode(decode(key))
+                    decoder.decode(decode(message))
+
+                label = f"{encoding}/{kind}/{name}"
+                results[f"encode/{label}"] = result(measure(encode, number // 10))
+                results[f"decode/{label}"] = result(
+                    measure(decode_message, number // 10)
+                )
+                results[f"size/{label}"] = {"unit": "bytes", "bytes": len(message)}
+    return results
+
+
+def greedy_keys(game):
+    """Keys placing the current piece as low as possible, lines first."""
+    placements = game.legal_placements()
+    if not placements:
+        return ""
+    best = max(placements, key=lambda p: (p.lines, p.y))
+    return game.target_keys(best.rotation, best.x)
+
+
+def bench_games(seeds):
+    results = {}
+    for name in ("random", "greedy"):
+        ticks = 0
+        start = time.perf_counter()
+        for seed in seeds:
+            game = Game(rng=random.Random(seed))
+            agent = RandomAgent(seed)
+            keys = None
+            while game.running:
+                state = game.step(keys)
+                ticks += 1
+                if name == "random":
+                    keys = agent.decide(state)
+                else:
+                    keys = greedy_keys(game) if game.current_piece else ""
+        elapsed = time.perf_counter() - start
+        results[f"games/{name}"] = result(elapsed / len(seeds), "game")
+        results[f"games/{name}/ticks"] = result(elapsed / ticks, "tick")
+    return results
+
+
+async def watch(port, stop):
+    import websockets
+
+    async with websockets.connect(f"ws://127.0.0.1:{port}/viewer") as websocket:
+        await websocket.send(json.dumps({"cmd": "join", "delta": True}))
+        while not stop.is_set():
+            await websocket.recv()
+
+
+async def play(port, encoding, stop):
+    """A player answering each frame with a key, games one after the other."""
+    import websockets
+
+    agent = RandomAgent(1)
+    while not stop.is_set():
+        async with websockets.connect(f"ws://127.0.0.1:{port}/player") as websocket:
+            join = {"cmd": "join", "name": "bench", "delta": True}
+            await websocket.send(json.dumps(dict(join, encoding=encoding)))
+            await websocket.recv()  # game info
+            decoder = DeltaDecoder()
+            while not stop.is_set():
+                state = decoder.decode(decode(await websocket.recv()))
+                if state is None:
+                    await websocket.send(json.dumps({"cmd": "resync"}))
+                elif "highscores" in state:
+                    break  # game over
+                else:
+                    keys = agent.decide(state)
+                    command = {"cmd": "key", "key": keys} if keys else {"cmd": "noop"}
+                    await websocket.send(json.dumps(command))
+
+
+async def serve(viewers, duration, port, client="bot"):
+    """Ticks per second of a lockstep game watched by viewers.
+
+    The game is played by a house bot within the server, or by a player
+    client over a websocket with the given encoding."""
+    import websockets
+    import server
+    from highscores import HighScores
+
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in ("Server", "Game", "HighScores"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    server.BOT_RESTART = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        highscores = HighScores(
+            os.path.join(directory, "highscores.json"),
+            os.path.join(directory, "highscores.log"),
+        )
+        game_server = server.GameServer(
+            0, -1, seed=1, lockstep=True, highscores=highscores
+        )
+        websocket_server = await websockets.serve(
+            game_server.incomming_handler, "127.0.0.1", port
+        )
+        stop = asyncio.Event()
+        watchers = [asyncio.ensure_future(watch(port, stop)) for _ in range(viewers)]
+        await asyncio.sleep(0.1)  # viewers connected, following the next game
+
+        ticks = 0
+        broadcast = game_server.broadcast
+
+        def count(session, message, droppable=True):
+            nonlocal ticks
+            if isinstance(message, Frames):
+                ticks += 1
+            broadcast(session, message, droppable)
+
+        game_server.broadcast = count
+        if client == "bot":
+            bot = game_server.house_bot("bench", "agents:RandomAgent")
+        else:
+            bot = play(port, client, stop)
+        bot = asyncio.ensure_future(bot)
+        start = time.perf_counter()
+        await asyncio.sleep(duration)
+        elapsed = time.perf_counter() - start
+
+        bot.cancel()
+        stop.set()
+        websocket_server.close()
+        await websocket_server.wait_closed()
+        for watcher in watchers:
+            watcher.cancel()
+        await asyncio.gather(bot, *watchers, return_exceptions=True)
+    return ticks / elapsed
+
+
+def bench_server(viewer_counts, duration, port):
+    results = {}
+    for client in ("bot", "json", "binary"):
+        for viewers in viewer_counts:
+            with contextlib.redirect_stdout(io.StringIO()):  # highscores printed
+                rate = asyncio.run(serve(viewers, duration, port, client))
+            label = "" if client == "bot" else f"{client}/"
+            results[f"server/{label}{viewers}_viewers"] = result(1 / rate, "tick")
+    return results
+
+
+def compare(results, baseline):
+    """Print the speedup of each benchmark over a previous run."""
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before or "seconds" not in current or "seconds" not in before:
+            continue
+        print(
+            f"{name:<40} {before['seconds'] * 1e6:>12.2f}us"
+            f" {current['seconds'] * 1e6:>12.2f}us"
+            f" {before['seconds'] / current['seconds']:>8.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("Game").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="results file", default="bench.json")
+    parser.add_argument("--compare", help="results of a previous run")
+    parser.add_argument(
+        "--only",
+        help="groups to run",
+        nargs="+",
+        choices=GROUPS,
+        default=GROUPS,
+    )
+    parser.add_argument(
+        "--number", help="iterations per benchmark", type=int, default=10000
+    )
+    parser.add_argument(
+        "--viewers",
+        help="numbers of viewers to run the server with",
+        type=int,
+        nargs="+",
+        default=[0, 1, 8],
+    )
+    parser.add_argument(
+        "--duration", help="seconds per server run", type=float, default=3
+    )
+    parser.add_argument(
+        "--port", help="loopback TCP port for the server", type=int, default=8765
+    )
+    args = parser.parse_args()
+
+    results = {}
+    if "engine" in args.only:
+        results.update(bench_engine(args.number))
+    if "protocol" in args.only:
+        results.update(bench_protocol(args.number))
+    if "games" in args.only:
+        results.update(bench_games(SEEDS))
+    if "server" in args.only:
+        results.update(bench_server(args.viewers, args.duration, args.port))
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+    with open(args.output, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    logger.info("%s benchmarks, results in %s", len(results), args.output)
+
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(results, json.load(infile)["results"])
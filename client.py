@@ -5,6 +5,8 @@ import os
 
 import websockets
 
+from protocol import decode
+
 # Next 4 lines are not needed for AI agents, please remove them from your code!
 import pygame
 
@@ -17,7 +19,9 @@ async def agent_loop(server_address="localhost:8000", agent_name="student"):
     async with websockets.connect(f"ws://{server_address}/player") as websocket:
 
         # Receive information about static game properties
-        await websocket.send(json.dumps({"cmd": "join", "name": agent_name}))
+        await websocket.send(
+            json.dumps({"cmd": "join", "name": agent_name, "encoding": "binary"})
+        )
 
         # Next 3 lines are not needed for AI agent
         SCREEN = pygame.display.set_mode((299, 123))
@@ -26,7 +30,7 @@ async def agent_loop(server_address="localhost:8000", agent_name="student"):
 
         while True:
             try:
-                state = json.loads(
+                state = decode(
                     await websocket.recv()
                 )  # receive game update, this must be called timely or your game will get out of sync with the server
 
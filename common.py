@@ -1,3 +1,20 @@
 from collections import namedtuple
+import os
+import tempfile
 
 Dimensions = namedtuple("Dimensions", ["x", "y"])
+
+
+def atomic_write(path, text):
+    """Replace the content of a file, readers see either the old or the new one."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as outfile:
+            outfile.write(text)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,92 @@
+"""Vectorized board features for evaluating many candidate boards at once.
+
+Boards are stacked into a boolean array of shape (N, height, width) holding
+the cells inside the walls, row 0 at the top. ``extract()`` computes all the
+usual evaluation features for the whole batch with NumPy operations.
+"""
+import numpy as np
+
+from common import Dimensions
+
+FEATURES = (
+    "aggregate_height",
+    "max_height",
+    "holes",
+    "bumpiness",
+    "row_transitions",
+    "column_transitions",
+    "wells",
+    "complete_lines",
+)
+
+
+def to_array(boards, dimensions=Dimensions(10, 30)):
+    """Stack boards into an (N, height, width) bool array of the cells inside the walls.
+
+    Each board may be a Game, a server state (its "game" list of cells) or
+    row masks with the walls included (Game.board, Placement.board).
+    dimensions are the game's, walls included, as sent in the game info."""
+    width, height = dimensions
+    batch = np.zeros((len(boards), height, width - 2), dtype=bool)
+    masks = []
+    for idx, board in enumerate(boards):
+        if hasattr(board, "board"):
+            board = board.board
+        if isinstance(board, dict):
+            cells = np.array(board["game"], dtype=np.intp).reshape(-1, 2)
+            batch[idx, cells[:, 1], cells[:, 0] - 1] = True
+        else:
+            masks.append((idx, board[:height]))
+
+    if masks:
+        index = [idx for idx, _ in masks]
+        rows = np.array([rows for _, rows in masks], dtype=np.uint64)
+        shifts = np.arange(1, width - 1, dtype=np.uint64)
+        batch[index] = (rows[:, :, None] >> shifts) & np.uint64(1)
+    return batch
+
+
+def heights(batch):
+    """Height of every column, (N, width)."""
+    height = batch.shape[1]
+    filled = batch.any(axis=1)
+    return np.where(filled, height - batch.argmax(axis=1), 0)
+
+
+def extract(batch):
+    """All FEATURES of a stacked batch of boards, as a dict of (N,) arrays,
+    plus the (N, width) column "heights"."""
+    n, height, width = batch.shape
+    column_heights = heights(batch)
+
+    # walls and floor count as filled
+    walled = np.ones((n, height, width + 2), dtype=bool)
+    walled[:, :, 1:-1] = batch
+    floored = np.ones((n, height + 1, width), dtype=bool)
+    floored[:, :-1, :] = batch
+
+    # empty cells with filled neighbours, summed as 1 + 2 + ... + depth per well
+    well = ~batch & walled[:, :, :-2] & walled[:, :, 2:]
+    run = np.zeros((n, width), dtype=np.int64)
+    wells = np.zeros(n, dtype=np.int64)
+    for row in range(height):
+        run = (run + 1) * well[:, row, :]
+        wells += run.sum(axis=1)
+
+    return {
+        "heights": column_heights,
+        "aggregate_height": column_heights.sum(axis=1),
+        "max_height": column_heights.max(axis=1),
+        "holes": column_heights.sum(axis=1) - batch.sum(axis=(1, 2)),
+        "bumpiness": np.abs(np.diff(column_heights, axis=1)).sum(axis=1),
+        "row_transitions": (walled[:, :, 1:] != walled[:, :, :-1]).sum(axis=(1, 2)),
+        "column_transitions": (floored[:, 1:, :] != floored[:, :-1, :]).sum(axis=(1, 2)),
+        "wells": wells,
+        "complete_lines": batch.all(axis=2).sum(axis=1),
+    }
+
+
+def feature_matrix(batch):
+    """FEATURES of a stacked batch as an (N, len(FEATURES)) array, for linear evaluation."""
+    values = extract(batch)
+    return np.stack([values[name] for name in FEATURES], axis=1)
@@ -2,24 +2,93 @@ from asyncio.queues import Queue
 import logging
 import random
 import asyncio
+import time
+from collections import deque, namedtuple
 from common import Dimensions
-from copy import deepcopy
-from shape import SHAPES
-from collections import Counter
+from shape import KINDS, ROTATIONS, Shape
+from zobrist import hash_board, hash_row, rehash
 
 logger = logging.getLogger("Game")
 logger.setLevel(logging.DEBUG)
 
 GAME_SPEED = 10
 SPEED_STEP = 10  # points
+MAX_KEYS = 16  # keys queued per tick
+LATE_FRACTION = 0.1  # of a period a tick may start after its deadline without being late
+
+Snapshot = namedtuple(
+    "Snapshot",
+    ["board", "piece", "next_pieces", "score", "lines", "speed", "game_speed", "running"],
+)
+"""What is needed to resume a game: row masks without the floor, the current
+piece as (kind, rotation, x, y) or None, and the kinds of the next pieces."""
+
+Placement = namedtuple(
+    "Placement", ["rotation", "x", "y", "cells", "lines", "keys", "board", "hash"]
+)
+"""Where a piece comes to rest, the lines it clears, the keys that take it there
+and the board that results (row masks, cleared lines removed) with its hash."""
+
+
+class TickScheduler:
+    """Paces ticks on absolute deadlines of a monotonic clock.
+
+    Each deadline is one period after the previous one, so the time spent on
+    a tick is taken from the next sleep rather than added to it. A tick more
+    than a whole period behind is an overrun: the schedule restarts from now
+    instead of bursting ticks to catch up."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self.deadline = None
+        self.start = None
+        self.ticks = 0
+        self.late = 0  # ticks started noticeably after their deadline
+        self.overruns = 0  # ticks more than a period late, schedule restarted
+        self.max_lateness = 0.0  # seconds
+        self._scheduled = 0.0  # sum of the periods, seconds the ticks should take
+
+    async def wait(self, rate):
+        """Sleep until the next tick is due, rate being ticks per second."""
+        period = 1.0 / rate
+        if self.deadline is None:
+            self.deadline = self.start = self._clock()
+        self.deadline += period
+        self._scheduled += period
+
+        delay = self.deadline - self._clock()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        lateness = self._clock() - self.deadline
+        self.ticks += 1
+        self.max_lateness = max(self.max_lateness, lateness)
+        if lateness > LATE_FRACTION * period:
+            self.late += 1
+        if lateness > period:
+            self.overruns += 1
+            self.deadline += lateness
+
+    def stats(self):
+        """Ticks so far, how many were late, and achieved versus target rate."""
+        elapsed = self._clock() - self.start if self.start is not None else 0
+        return {
+            "ticks": self.ticks,
+            "late": self.late,
+            "overruns": self.overruns,
+            "max_lateness": self.max_lateness,
+            "target_rate": self.ticks / self._scheduled if self._scheduled else 0,
+            "achieved_rate": self.ticks / elapsed if elapsed else 0,
+        }
 
 
 class Game:
-    def __init__(self, x=10, y=30) -> None:
+    def __init__(self, x=10, y=30, rng=random) -> None:
         logger.info("Game")
         self.dimensions = Dimensions(x, y)
+        self._rng = rng  # source of pieces, random.Random instances keep games independent
         self.current_piece = None
-        self.next_pieces = [deepcopy(random.choice(SHAPES)) for _ in range(3)]
+        self.next_pieces = [Shape(rng.choice(KINDS)) for _ in range(3)]
 
         self._bottom = [(i, y) for i in range(x)]  # bottom
         self._lateral = [(0, i) for i in range(y)]  # left
@@ -27,11 +96,20 @@ class Game:
 
         self.grid = self._bottom + self._lateral
 
-        self.game = []
+        # bitboard: one int per row, bit x set for occupied cells (walls and floor included)
+        self._empty_row = 1 | 1 << (x - 1)
+        self._full_row = (1 << x) - 1
+        self._board = [self._empty_row] * y + [self._full_row]
+        self._game = None
+        self.hash = hash_board(self._board)  # zobrist hash, kept up to date
+
         self.score = 0
+        self.lines = 0  # cleared so far
         self.speed = 1
         self.game_speed = 10
-        self._lastkeypress = None
+        self._keys = deque()  # keys to apply on the next tick
+        self.version = 0  # bumped whenever locked cells change
+        self.scheduler = TickScheduler()  # paces loop()
 
         self.running = True
 
@@ -43,38 +121,125 @@ class Game:
             "score": self.score
         }
 
+    @property
+    def board(self):
+        """Row bitmasks of locked cells, walls and floor, bit x of row y for cell (x, y)."""
+        return self._board
+
+    @property
+    def game(self):
+        """Locked cells as a list of (x, y) tuples, derived from the bitboard."""
+        if self._game is None:
+            self._game = [
+                (x, y)
+                for y, row in enumerate(self._board[:-1])
+                if row != self._empty_row
+                for x in range(1, self.dimensions.x - 1)
+                if row >> x & 1
+            ]
+        return self._game
+
+    def lock(self, piece):
+        """Add piece to the locked cells."""
+        x, y = piece.x, piece.y
+        board = self._board
+        for dy, mask in piece.shape.rows:
+            row = y + dy
+            locked = board[row] | (mask << x if x >= 0 else mask >> -x)
+            self.hash ^= hash_row(row, board[row]) ^ hash_row(row, locked)
+            board[row] = locked
+        self._game = None
+        self.version += 1
+
     def clear_rows(self):
-        lines = 0
-
-        for item, count in sorted(Counter(y for _, y in self.game).most_common()):
-            if count == len(self._bottom) - 2:
-                self.game = [
-                    (x, y + 1) if y < item else (x, y)
-                    for (x, y) in self.game
-                    if y != item
-                ]  # remove row and drop lines
-                lines += 1
+        board = self._board
+        full = [y for y in range(self.dimensions.y) if board[y] == self._full_row]
+        lines = len(full)
+
+        if lines:
+            for item in full:
                 logger.debug("Clear line %s", item)
+            # remove full rows and drop the ones above
+            self._board = (
+                [self._empty_row] * lines
+                + [row for row in board[:-1] if row != self._full_row]
+                + board[-1:]
+            )
+            self.hash = rehash(self.hash, board, self._board, range(full[-1] + 1))
+            self._game = None
 
+        self.lines += lines
         self.score += lines ** 2
 
         self.game_speed = GAME_SPEED + self.score // SPEED_STEP
 
-        most_common = Counter(y for _, y in self.game).most_common(1)
-        if most_common != []:
-            (_, count) = most_common[0]
-            assert count != len(self._bottom) - 2, f"please create an issue https://github.com/dgomes/ia-tetris/issues sharing:\n {self.game}"
+    def snapshot(self):
+        """The state of the game, to resume it later with restore()."""
+        piece = self.current_piece
+        return Snapshot(
+            tuple(self._board[:-1]),
+            (piece.name, piece.rotation, piece.x, piece.y) if piece else None,
+            tuple(n.name for n in self.next_pieces),
+            self.score,
+            self.lines,
+            self.speed,
+            self.game_speed,
+            self.running,
+        )
+
+    def restore(self, snapshot, rng=None):
+        """Resume a snapshot(), rng deals the pieces from now on if given."""
+        self._board = list(snapshot.board) + [self._full_row]
+        self._game = None
+        self.hash = hash_board(self._board)
+        self.current_piece = Shape(*snapshot.piece) if snapshot.piece else None
+        self.next_pieces = [Shape(kind) for kind in snapshot.next_pieces]
+        self.score = snapshot.score
+        self.lines = snapshot.lines
+        self.speed = snapshot.speed
+        self.game_speed = snapshot.game_speed
+        self.running = snapshot.running
+        self._keys.clear()
+        self.version += 1
+        if rng is not None:
+            self._rng = rng
 
     def keypress(self, key):
-        """Update locally last key pressed."""
-        self._lastkeypress = key
+        """Queue a key to be applied on the next tick, False if the queue is full."""
+        if not key:
+            return True
+        if len(self._keys) >= MAX_KEYS:
+            return False
+        self._keys.append(key)
+        return True
+
+    def target_keys(self, rotation, x):
+        """Keys that take the current (or next) piece to a placement and drop it.
+
+        None if rotation and x are not a placement the piece can reach."""
+        if type(rotation) is not int or type(x) is not int:
+            return None
+        for placement in self.legal_placements():
+            if placement.rotation == rotation and placement.x == x:
+                return placement.keys
+        return None
 
     async def loop(self):
+        """Advance one tick at game speed."""
         logger.info("Loop - score: %s - speed: %s", self.score, self.game_speed)
-        await asyncio.sleep(1.0 / self.game_speed)
+        await self.scheduler.wait(self.game_speed)
+        return self.step()
+
+    def step(self, keys=None):
+        """Advance exactly one tick, synchronously, and return the new state.
+
+        keys, a string or list, are queued first as with keypress()."""
+        for key in keys or ():
+            self.keypress(key)
+
         if self.current_piece is None:
             self.current_piece = self.next_pieces.pop(0)
-            self.next_pieces.append(deepcopy(random.choice(SHAPES)))
+            self.next_pieces.append(Shape(self._rng.choice(KINDS)))
 
             logger.debug("New piece: %s", self.current_piece)
             self.current_piece.set_pos(
@@ -86,37 +251,22 @@ class Game:
 
         self.current_piece.y += 1
 
+        applied = []
         if self.valid(self.current_piece):
-            if self._lastkeypress == "s":
-                while self.valid(self.current_piece):
-                    self.current_piece.y += 1
-                self.current_piece.y -= 1
-            elif self._lastkeypress == "w":
-                self.current_piece.rotate()
-                if not self.valid(self.current_piece):
-                    self.current_piece.rotate(-1)
-            elif self._lastkeypress == "a":
-                shift = -1
-            elif self._lastkeypress == "d":
-                shift = +1
-
-            if self._lastkeypress in ["a", "d"]:
-                self.current_piece.translate(shift, 0)
-                if self.collide_lateral(self.current_piece):
-                    logger.debug("Hitting the wall")
-                    self.current_piece.translate(-shift, 0)
-                elif not self.valid(self.current_piece):
-                    self.current_piece.translate(-shift, 0)
+            while self._keys:
+                key = self._keys.popleft()
+                if self.move(key):
+                    applied.append(key)
 
         else:
             self.current_piece.y -= 1
-            self.game.extend(self.current_piece.positions)
+            self.lock(self.current_piece)
 
             self.clear_rows()
 
             self.current_piece = None
 
-        self._lastkeypress = None
+        self._keys.clear()
 
         logger.debug("Current piece: %s", self.current_piece)
         return {
@@ -125,12 +275,151 @@ class Game:
             "next_pieces": [n.positions for n in self.next_pieces],
             "game_speed": self.game_speed,
             "score": self.score,
+            "applied": applied,
         }
 
+    def move(self, key):
+        """Apply a key to the current piece, False if the move was not possible."""
+        piece = self.current_piece
+        if key == "s":
+            while self.valid(piece):
+                piece.y += 1
+            piece.y -= 1
+            return True
+
+        if key == "w":
+            piece.rotate()
+            if not self.valid(piece):
+                piece.rotate(-1)
+                return False
+            return True
+
+        if key in ["a", "d"]:
+            shift = -1 if key == "a" else +1
+            piece.translate(shift, 0)
+            if self.collide_lateral(piece):
+                logger.debug("Hitting the wall")
+                piece.translate(-shift, 0)
+                return False
+            if not self.valid(piece):
+                piece.translate(-shift, 0)
+                return False
+            return True
+
+        return False
+
     def valid(self, piece):
-        return not any(
-            [piece_part in self.grid for piece_part in piece.positions]
-        ) and not any([piece_part in self.game for piece_part in piece.positions])
+        return self.fits(piece.shape, piece.x, piece.y)
+
+    def fits(self, shape, x, y, board=None):
+        """Whether a compiled rotation placed at (x, y) is free on the board."""
+        min_x, _, max_x, _ = shape.box
+        if x + min_x < 0 or x + max_x >= self.dimensions.x:
+            return False
+
+        if board is None:
+            board = self._board
+        for dy, mask in shape.rows:
+            row = y + dy
+            if row >= len(board):
+                return False
+            if row >= 0 and board[row] & (mask << x if x >= 0 else mask >> -x):
+                return False
+        return True
+
+    def legal_placements(self, piece=None, board=None):
+        """All resting positions a piece can reach with keys sent now.
+
+        The piece defaults to the current one, any other piece (or the next
+        one, if none is falling) is placed where it would spawn. Keys take
+        effect on the next tick, one row below. A board (row masks, as in
+        Game.board or Placement.board) may be given to look ahead."""
+        if board is None:
+            board = self._board
+            board_hash = self.hash
+        else:
+            board_hash = hash_board(board)
+        if piece is None:
+            piece = self.current_piece or self.next_pieces[0]
+        if piece is self.current_piece:
+            x, y = piece.x, piece.y + 1
+        else:
+            x, y = (self.dimensions.x - piece.dimensions.x) // 2, 1
+
+        rotations = ROTATIONS[piece.name]
+        start = (piece.rotation, x)
+        if not self.fits(rotations[piece.rotation], x, y, board):
+            return []
+
+        # shortest key sequence to every (rotation, x) reachable at this height
+        paths = {start: ""}
+        frontier = [start]
+        for rotation, x in frontier:
+            keys = paths[rotation, x]
+            for key, move in (
+                ("w", ((rotation + 1) % len(rotations), x)),
+                ("a", (rotation, x - 1)),
+                ("d", (rotation, x + 1)),
+            ):
+                if move not in paths and self.fits(rotations[move[0]], move[1], y, board):
+                    paths[move] = keys + key
+                    frontier.append(move)
+
+        # topmost locked cell of each column
+        height = len(board) - 1
+        tops = {}
+        seen = 0
+        for row_y, row in enumerate(board):
+            new = row & ~seen
+            while new:
+                bit = new & -new
+                tops[bit.bit_length() - 1] = row_y
+                new ^= bit
+            seen |= row
+            if row_y == height:
+                break
+
+        placements = []
+        for (rotation, x), keys in paths.items():
+            shape = rotations[rotation]
+            drop = min(tops[x + dx] - (y + dy) - 1 for dx, dy in shape.bottoms)
+            if drop >= 0:
+                rest = y + drop
+            else:  # overhang above the piece, drop row by row
+                rest = y
+                while self.fits(shape, x, rest + 1, board):
+                    rest += 1
+
+            rows = list(board)
+            for dy, mask in shape.rows:
+                rows[rest + dy] |= mask << x if x >= 0 else mask >> -x
+            full = [row for row in rows[:height] if row == self._full_row]
+            if full:
+                rows = (
+                    [self._empty_row] * len(full)
+                    + [row for row in rows[:height] if row != self._full_row]
+                    + rows[height:]
+                )
+                changed = range(rest + shape.box[3] + 1)
+            else:
+                changed = range(rest + shape.box[1], rest + shape.box[3] + 1)
+
+            placements.append(
+                Placement(
+                    rotation,
+                    x,
+                    rest,
+                    [(x + cx, rest + cy) for cx, cy in shape.cells],
+                    len(full),
+                    keys + "s",
+                    tuple(rows),
+                    rehash(board_hash, board, rows, changed),
+                )
+            )
+        return placements
 
     def collide_lateral(self, piece):
-        return any([piece_part in self._lateral for piece_part in piece.positions])
+        return any(
+            (x == 0 or x == self.dimensions.x - 1) and 0 <= y < self.dimensions.y
+            for x, y in piece.positions
+        )
@@ -0,0 +1,103 @@
+"""Highscore table kept in memory and persisted off the event loop.
+
+Every score is appended to a log file, which is periodically compacted into
+a snapshot of the current table. Both writes run in a worker thread and the
+snapshot is replaced atomically, so a crash never truncates the table.
+"""
+import heapq
+import json
+import logging
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+
+from common import atomic_write
+
+logger = logging.getLogger("HighScores")
+logger.setLevel(logging.INFO)
+
+HIGHSCORE_FILE = "highscores.json"
+HIGHSCORE_LOG = "highscores.log"
+MAX_HIGHSCORES = 10
+COMPACT_EVERY = 100  # log entries between compactions
+
+
+class HighScores:
+    """Bounded table of the best (player, score) pairs."""
+
+    def __init__(self, path=HIGHSCORE_FILE, log=HIGHSCORE_LOG, size=MAX_HIGHSCORES):
+        self.path = path
+        self.log = log
+        self.size = size
+        self._heap = []  # (score, -id, player), lowest score and newest entry first out
+        self._last_id = 0
+        self._logged = 0  # entries in the log since the last compaction
+        self._io = ThreadPoolExecutor(max_workers=1)  # writes stay in order
+
+        compacted = 0
+        if os.path.isfile(path):
+            with open(path, "r") as infile:
+                snapshot = json.load(infile)
+            if isinstance(snapshot, list):  # table written by older servers
+                snapshot = {"compacted": 0, "highscores": snapshot}
+            compacted = self._last_id = snapshot["compacted"]
+            table = snapshot["highscores"]
+            for rank, (player, score) in enumerate(table):
+                self._push(player, score, rank - len(table))  # older than logged entries
+
+        if os.path.isfile(log):
+            with open(log, "r") as infile:
+                for line in infile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # partially written last line
+                    if entry["id"] > compacted:
+                        self._push(entry["player"], entry["score"], entry["id"])
+                        self._logged += 1
+                    self._last_id = max(self._last_id, entry["id"])
+
+    def _push(self, player, score, entry_id):
+        item = (score, -entry_id, player)
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def top(self):
+        """Highscores as [player, score] lists, best first."""
+        return [[player, score] for score, _, player in sorted(self._heap, reverse=True)]
+
+    def add(self, player, score):
+        """Record a score, writing it to disk in the background."""
+        self._last_id += 1
+        self._push(player, score, self._last_id)
+
+        entry = {"id": self._last_id, "player": player, "score": score}
+        self._write(self._append, entry)
+        self._logged += 1
+        if self._logged >= COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        """Write the table to the snapshot file and start a new log."""
+        snapshot = {"compacted": self._last_id, "highscores": self.top()}
+        self._logged = 0
+        self._write(self._compact, snapshot)
+
+    def _write(self, function, *args):
+        future = self._io.submit(function, *args)
+        future.add_done_callback(self._check)
+
+    @staticmethod
+    def _check(future):
+        if future.exception():
+            logger.error("Could not save highscores: %s", future.exception())
+
+    def _append(self, entry):
+        with open(self.log, "a") as outfile:
+            outfile.write(json.dumps(entry) + "\n")
+
+    def _compact(self, snapshot):
+        atomic_write(self.path, json.dumps(snapshot))
+        with open(self.log, "w"):
+            pass  # entries up to snapshot["compacted"] are in the snapshot
@@ -1,3 +1,11 @@
+from sqlalchemy import inspect
+
 from grading import db
 
 db.create_all()
+
+# columns added since the table was first created
+columns = {column['name'] for column in inspect(db.engine).get_columns('game')}
+for name, kind in [('replay', 'BLOB'), ('verdict', 'VARCHAR(10)'), ('verified_score', 'INTEGER')]:
+    if name not in columns:
+        db.engine.execute(f'ALTER TABLE game ADD COLUMN {name} {kind}')
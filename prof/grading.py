@@ -1,11 +1,19 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
+import base64
 import os
-from sqlalchemy import and_, func
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from sqlalchemy import and_, or_, func
 
 app = Flask(__name__, static_url_path='')
 basedir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(basedir))  # the game, to verify replays
+
+import replay
+
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'grades.sqlite')
 db = SQLAlchemy(app)
 ma = Marshmallow(app)
@@ -16,34 +24,93 @@ class Game(db.Model):
     timestamp = db.Column(db.DateTime, server_default=db.func.now())
     player = db.Column(db.String(25))
     score = db.Column(db.Integer)
+    replay = db.Column(db.LargeBinary)
+    verdict = db.Column(db.String(10))  # pending, valid, invalid or None without replay
+    verified_score = db.Column(db.Integer)
 
-    def __init__(self, player, score):
+    def __init__(self, player, score, replay=None):
         self.player = player
         self.score = score
+        self.replay = replay
+        self.verdict = 'pending' if replay else None
 
 class GameSchema(ma.Schema):
     class Meta:
         # Fields to expose
-        fields = ('id', 'timestamp', 'player', 'score')
+        fields = ('id', 'timestamp', 'player', 'score', 'verdict', 'verified_score')
 
 
 game_schema = GameSchema()
 games_schema = GameSchema(many=True)
 
 
-# endpoint to create new game
+verifier = ProcessPoolExecutor()  # replays are verified away from the requests
+VERIFY_BATCH = 10  # replays sent to a worker at once
+MAX_REPLAY = 4 * 1024 * 1024  # base64 characters of a replay, larger ones are refused
+
+
+def verify(player, score, data):
+    """Play a replay again, return the verdict and the score it reaches."""
+    try:
+        game_replay = replay.parse(data)
+        verified_score = replay.simulate(game_replay, strict=True).score
+    except Exception:
+        return 'invalid', None
+    if game_replay.player != player or verified_score != score:
+        return 'invalid', verified_score
+    return 'valid', verified_score
+
+
+def verify_all(records):
+    return [verify(*record) for record in records]
+
+
+def save_verdicts(ids, future):
+    with app.app_context():
+        for game_id, (verdict, verified_score) in zip(ids, future.result()):
+            game = Game.query.get(game_id)
+            game.verdict = verdict
+            game.verified_score = verified_score
+        db.session.commit()
+
+
+def verify_games(games):
+    """Verify the replays of games in the background, in batches over the workers."""
+    games = [game for game in games if game.replay]
+    for i in range(0, len(games), VERIFY_BATCH):
+        batch = games[i:i + VERIFY_BATCH]
+        future = verifier.submit(verify_all, [(g.player, g.score, g.replay) for g in batch])
+        future.add_done_callback(partial(save_verdicts, [game.id for game in batch]))
+
+
+# endpoint to create new game(s), accepts a single record or a list of them,
+# with the base64 replay of the game to verify the score
 @app.route("/game", methods=["POST"])
 def add_game():
-    player = request.json['player']
-    score = request.json['score']
+    records = request.json if isinstance(request.json, list) else [request.json]
 
-    print(player, score)
-    new_game = Game(player, score)
+    new_games = []
+    for record in records:
+        player = record['player']
+        score = record['score']
+        if len(record.get('replay') or '') > MAX_REPLAY:
+            abort(413)
+        data = base64.b64decode(record['replay']) if record.get('replay') else None
 
-    db.session.add(new_game)
+        print(player, score)
+        new_games.append(Game(player, score, data))
+
+    db.session.add_all(new_games)
     db.session.commit()
+    verify_games(new_games)
+
+    if isinstance(request.json, list):
+        return games_schema.jsonify(new_games)
+    return game_schema.jsonify(new_games[0])
+
+# games whose replay did not check out are left out of the highscores
+not_invalid = or_(Game.verdict.is_(None), Game.verdict != 'invalid')
 
-    return game_schema.jsonify(new_game)
 
 @app.route("/static/<path:path>")
 def send_static(path):
@@ -54,21 +121,24 @@ def send_static(path):
 def get_game():
     page = request.args.get('page', 1, type=int)
 
-    q = db.session.query(Game.id, Game.timestamp, Game.player, func.max(Game.score).label('score')).group_by(Game.player).order_by(Game.score.desc(), Game.timestamp.desc())
+    q = db.session.query(Game.id, Game.timestamp, Game.player, func.max(Game.score).label('score')).filter(not_invalid).group_by(Game.player).order_by(Game.score.desc(), Game.timestamp.desc())
 #    print(q.statement)
 
     all_games = q.paginate(page, 20, False)
     result = games_schema.dump(all_games.items)
-    return jsonify(result)
+    response = jsonify(result)
+    response.add_etag()  # viewers revalidate with If-None-Match
+    return response.make_conditional(request)
 
 
 # endpoint to show player games
 @app.route("/highscores/<player>", methods=["GET"])
 def game_detail(player):
-    game = db.session.query(Game).filter(and_(Game.player == player, Game.score > 0)).order_by(Game.score.desc()).limit(10)
+    game = db.session.query(Game).filter(and_(Game.player == player, Game.score > 0, not_invalid)).order_by(Game.score.desc()).limit(10)
     result = games_schema.dump(game)
     return jsonify(result)
 
 
 if __name__ == '__main__':
+    verify_games(Game.query.filter_by(verdict='pending').all())  # left by a restart
     app.run(debug=False, host='0.0.0.0', port=80)
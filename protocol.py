@@ -0,0 +1,191 @@
+"""Websocket protocol helpers shared by the server, the client and the viewer.
+
+Clients may ask for delta encoded updates by joining with ``"delta": true``.
+Every update then carries a ``seq`` number. Keyframes are full states and are
+sent whenever the locked cells change (or on request, with
+``{"cmd": "resync"}``), in between only the falling piece is sent, plus the
+next pieces as ``"next": [[kind, rotation], ...]`` when a piece spawns.
+
+Game updates may also be sent as binary frames by joining with
+``"encoding": "binary"``, the board packed as row bitmasks and pieces as
+kind/rotation/x/y. Game info and highscores are always JSON text frames.
+Use ``decode()`` to get the same dictionaries for both encodings.
+"""
+import json
+import struct
+
+from shape import KINDS, Shape
+
+ENCODINGS = ("json", "binary")
+
+BINARY_VERSION = 3
+KEYFRAME, HAS_PIECE, HAS_NEXT = 1, 2, 4  # binary header flags
+NO_PIECE = 255
+
+HEADER = struct.Struct("<BBIIHBB")  # version, flags, seq, score, game_speed, width, height
+PIECE = struct.Struct("<BBbb")  # kind, rotation, x, y
+KIND_INDEX = {kind: idx for idx, kind in enumerate(KINDS)}
+
+
+def encode_binary(game, state, seq, keyframe, next_pieces=False):
+    """Pack a tick of a Game, keyframes carry the board, next pieces and player.
+
+    Delta frames carry the next pieces too when next_pieces is set."""
+    piece = game.current_piece
+    width, height = game.dimensions
+    next_pieces = next_pieces or keyframe
+    flags = (
+        (KEYFRAME if keyframe else 0)
+        | (HAS_PIECE if piece else 0)
+        | (HAS_NEXT if next_pieces else 0)
+    )
+
+    data = [HEADER.pack(BINARY_VERSION, flags, seq, game.score, game.game_speed, width, height)]
+    if piece:
+        data.append(PIECE.pack(KIND_INDEX[piece.name], piece.rotation, piece.x, piece.y))
+    applied = "".join(state.get("applied", [])).encode()
+    data.append(struct.pack("<B", len(applied)) + applied)
+
+    if next_pieces:
+        data.append(struct.pack("<B", len(game.next_pieces)))
+        for nxt in game.next_pieces:
+            data.append(PIECE.pack(KIND_INDEX[nxt.name], nxt.rotation, nxt.x, nxt.y))
+
+    if keyframe:
+        walls = 1 | 1 << (width - 1)
+        data.append(struct.pack(f"<{height}I", *[row & ~walls for row in game.board[:height]]))
+        player = state.get("player", "").encode("utf-8")[:255]
+        data.append(struct.pack("<B", len(player)) + player)
+    return b"".join(data)
+
+
+def _positions(kind, rotation, x, y):
+    return [[px, py] for px, py in Shape(KINDS[kind], rotation, x, y).positions]
+
+
+def decode_binary(data):
+    """Unpack a binary frame into the same dictionary as its JSON counterpart."""
+    version, flags, seq, score, game_speed, width, height = HEADER.unpack_from(data)
+    if version != BINARY_VERSION:
+        raise ValueError(f"unsupported binary frame version {version}")
+    offset = HEADER.size
+
+    piece = None
+    if flags & HAS_PIECE:
+        piece = _positions(*PIECE.unpack_from(data, offset))
+        offset += PIECE.size
+    (length,) = struct.unpack_from("<B", data, offset)
+    applied = list(data[offset + 1 : offset + 1 + length].decode())
+    offset += 1 + length
+
+    next_pieces = []
+    if flags & HAS_NEXT:
+        (count,) = struct.unpack_from("<B", data, offset)
+        offset += 1
+        for _ in range(count):
+            next_pieces.append(_positions(*PIECE.unpack_from(data, offset)))
+            offset += PIECE.size
+
+    if not flags & KEYFRAME:
+        delta = {"seq": seq, "piece": piece, "applied": applied}
+        if flags & HAS_NEXT:
+            delta["next_pieces"] = next_pieces
+        return delta
+
+    rows = struct.unpack_from(f"<{height}I", data, offset)
+    offset += 4 * height
+    (length,) = struct.unpack_from("<B", data, offset)
+    player = data[offset + 1 : offset + 1 + length].decode("utf-8", "ignore")  # cut at 255 bytes
+
+    state = {
+        "game": [[x, y] for y, row in enumerate(rows) if row for x in range(width) if row >> x & 1],
+        "piece": piece,
+        "next_pieces": next_pieces,
+        "game_speed": game_speed,
+        "score": score,
+        "applied": applied,
+        "seq": seq,
+    }
+    if player:
+        state["player"] = player
+    return state
+
+
+def decode(message):
+    """Decode a server message, either a JSON text frame or a binary frame."""
+    if isinstance(message, bytes):
+        return decode_binary(message)
+    return json.loads(message)
+
+
+class Frames:
+    """Encodings of a single tick, each one computed at most once."""
+
+    def __init__(self, state, seq, keyframe, game=None, spawned=False):
+        self.state = state
+        self.seq = seq
+        self.keyframe = keyframe
+        self.game = game  # needed for binary encoding
+        self.spawned = spawned  # next pieces changed, deltas carry them
+        self._cache = {}
+
+    def get(self, delta=False, keyframe=False, encoding="json"):
+        """Message for a connection, full state unless delta was negotiated."""
+        if not delta:
+            kind = "full"
+        elif keyframe or self.keyframe:
+            kind = "key"
+        else:
+            kind = "delta"
+
+        if (encoding, kind) not in self._cache:
+            if encoding == "binary":
+                message = encode_binary(
+                    self.game, self.state, self.seq, kind != "delta", self.spawned
+                )
+            elif kind == "full":
+                message = json.dumps(self.state)
+            elif kind == "key":
+                message = json.dumps(dict(self.state, seq=self.seq))
+            else:
+                delta = {
+                    "seq": self.seq,
+                    "piece": self.state["piece"],
+                    "applied": self.state["applied"],
+                }
+                if self.spawned:
+                    delta["next"] = [
+                        [n.name, n.rotation] for n in self.game.next_pieces
+                    ]
+                message = json.dumps(delta)
+            self._cache[encoding, kind] = message
+        return self._cache[encoding, kind]
+
+
+class DeltaDecoder:
+    """Rebuild full states from a delta encoded stream."""
+
+    def __init__(self):
+        self.state = None
+        self.seq = None
+
+    def decode(self, message):
+        """Return the full state, or None when out of sync and a resync is needed."""
+        if "seq" not in message:
+            return message  # game info and highscores are never delta encoded
+
+        if "game" in message:
+            self.state = message
+        elif self.state is None or message["seq"] != self.seq + 1:
+            self.state = None
+            return None
+        else:
+            self.state = dict(self.state, **message)
+            if "next" in message:
+                self.state["next_pieces"] = [
+                    [list(cell) for cell in Shape(kind, rotation).positions]
+                    for kind, rotation in self.state.pop("next")
+                ]
+
+        self.seq = message["seq"]
+        return self.state
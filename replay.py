@@ -0,0 +1,269 @@
+"""Compact game replays.
+
+A replay holds what is needed to play a game again: the pieces it was dealt
+and the keys applied on each tick. It is a header followed by a stream of
+varints, written as the game goes:
+
+    header  magic, version, width, height, seed, timestamp, player,
+            the initial next pieces
+    tick    (keys << 2) | (spawned << 1) | 1, the kind of the piece dealt when
+            spawned, then the keys, 2 bits each, 4 to a byte
+    idle    idle << 1, a run of ticks without keys nor pieces dealt
+    end     0, then the final score, lines and ticks
+
+Pieces come from the game's random generator and are recorded as they are
+drawn, so games replay exactly whatever the seed or Python version. Checking
+that a replay is genuine (simulate(strict=True)) deals them again from the
+seed.
+
+    $ python3 replay.py replays/*.replay
+"""
+import argparse
+import logging
+import random
+import struct
+import time
+from collections import namedtuple
+
+from game import Game
+from shape import KINDS
+
+logger = logging.getLogger("Replay")
+logger.setLevel(logging.INFO)
+
+MAGIC = b"TRPL"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBQd")  # magic, version, width, height, seed, timestamp
+MAX_TICKS = 1 << 20  # longest game a replay may hold, replays can be untrusted
+
+KEYS = "wads"
+KEY_CODES = {key: code for code, key in enumerate(KEYS)}
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+Replay = namedtuple(
+    "Replay",
+    ["width", "height", "seed", "timestamp", "player", "pieces", "ticks", "final"],
+)
+Final = namedtuple("Final", ["score", "lines", "ticks"])
+
+
+def varint(value, out):
+    """Append an unsigned LEB128 varint to a bytearray."""
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    """Decode the varint at pos, return it and the position after it."""
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class RecordingRandom:
+    """Draw pieces from a random generator, remembering them."""
+
+    def __init__(self, rng, drawn):
+        self._rng = rng
+        self._drawn = drawn
+
+    def choice(self, seq):
+        kind = self._rng.choice(seq)
+        self._drawn.append(kind)
+        return kind
+
+
+class SequenceRandom:
+    """Deal recorded pieces in order."""
+
+    def __init__(self, kinds):
+        self._kinds = iter(kinds)
+        self.drawn = 0
+
+    def choice(self, seq):
+        self.drawn += 1
+        return next(self._kinds)
+
+
+class ReplayWriter:
+    """Record a game to a file, tick by tick.
+
+    Games must be created with the writer's rng, so the pieces are recorded:
+
+        writer = ReplayWriter(path, seed, player)
+        game = Game(rng=writer.rng)
+        writer.start(game)
+    """
+
+    def __init__(self, path, seed, player="", rng=None):
+        self.path = path
+        self.seed = seed
+        self.player = player
+        self._drawn = []
+        self.rng = RecordingRandom(rng or random.Random(seed), self._drawn)
+        self._file = None
+        self._idle = 0  # idle ticks not written yet
+        self._ticks = 0
+
+    def start(self, game):
+        """Write the header, with the pieces already dealt to the game."""
+        width, height = game.dimensions
+        name = self.player.encode("utf-8")[:255]
+        out = bytearray(
+            HEADER.pack(MAGIC, VERSION, width, height, self.seed, time.time())
+        )
+        out.append(len(name))
+        out += name
+        out.append(len(self._drawn))
+        out += bytes(KIND_CODES[kind] for kind in self._drawn)
+        self._drawn.clear()
+
+        self._file = open(self.path, "wb", buffering=64 * 1024)
+        self._file.write(out)
+
+    def tick(self, applied):
+        """Record the keys applied on a tick, and the piece dealt if any."""
+        self._ticks += 1
+        if not applied and not self._drawn:
+            self._idle += 1
+            return
+
+        out = bytearray()
+        if self._idle:
+            varint(self._idle << 1, out)
+            self._idle = 0
+        spawned = 1 if self._drawn else 0
+        varint(len(applied) << 2 | spawned << 1 | 1, out)
+        if spawned:
+            out.append(KIND_CODES[self._drawn.pop()])
+        for i in range(0, len(applied), 4):
+            packed = 0
+            for j, key in enumerate(applied[i : i + 4]):
+                packed |= KEY_CODES[key] << 2 * j
+            out.append(packed)
+        self._file.write(out)
+
+    def close(self, game):
+        """Write the final score and close the file."""
+        if self._file is None:
+            return
+        out = bytearray()
+        if self._idle:
+            varint(self._idle << 1, out)
+        out.append(0)
+        varint(game.score, out)
+        varint(game.lines, out)
+        varint(self._ticks, out)
+        self._file.write(out)
+        self._file.close()
+        self._file = None
+
+
+def parse(data):
+    """Decode a replay, as recorded so far if the game did not end.
+
+    Raises ValueError on replays of more than MAX_TICKS ticks."""
+    magic, version, width, height, seed, timestamp = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a replay, or an unsupported version")
+    pos = HEADER.size
+    size = data[pos]
+    player = bytes(data[pos + 1 : pos + 1 + size]).decode("utf-8")
+    pos += 1 + size
+    size = data[pos]
+    pieces = [KINDS[code] for code in data[pos + 1 : pos + 1 + size]]
+    pos += 1 + size
+
+    ticks = []  # keys applied on each tick
+    final = None
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        if value == 0:
+            score, pos = read_varint(data, pos)
+            lines, pos = read_varint(data, pos)
+            count, pos = read_varint(data, pos)
+            final = Final(score, lines, count)
+            break
+        idle = 1 if value & 1 else value >> 1
+        if len(ticks) + idle > MAX_TICKS:
+            raise ValueError("replay longer than MAX_TICKS")
+        if not value & 1:
+            ticks.extend([""] * idle)
+            continue
+        if value & 2:
+            pieces.append(KINDS[data[pos]])
+            pos += 1
+        count = value >> 2
+        keys = []
+        for i in range(0, count, 4):
+            packed = data[pos]
+            pos += 1
+            for j in range(min(4, count - i)):
+                keys.append(KEYS[packed >> 2 * j & 3])
+        ticks.append("".join(keys))
+
+    return Replay(width, height, seed, timestamp, player, pieces, ticks, final)
+
+
+def load(path):
+    """Read and decode a replay file."""
+    with open(path, "rb") as infile:
+        return parse(infile.read())
+
+
+def simulate(replay, strict=False):
+    """Play a replay again, return the game as it ended.
+
+    strict checks that the replay could come from a real game, raising
+    ValueError otherwise: its pieces must be those dealt by its seed, and no
+    tick may follow the game over."""
+    if strict:
+        dealer = random.Random(replay.seed)
+        if [dealer.choice(KINDS) for _ in replay.pieces] != replay.pieces:
+            raise ValueError("pieces were not dealt from the seed")
+
+    rng = SequenceRandom(replay.pieces)
+    game = Game(replay.width, replay.height, rng=rng)
+    for keys in replay.ticks:
+        if strict and not game.running:
+            raise ValueError("ticks after the game over")
+        game.step(keys)
+
+    if strict and rng.drawn != len(replay.pieces):
+        raise ValueError("pieces that were never dealt")
+    return game
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("Game").setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("replays", help="replay files", nargs="+")
+    args = parser.parse_args()
+
+    for path in args.replays:
+        replay = load(path)
+        start = time.perf_counter()
+        game = simulate(replay)
+        elapsed = time.perf_counter() - start
+
+        recorded = replay.final.score if replay.final else None
+        logger.info(
+            "%s: <%s> seed %s, %s ticks, score %s (recorded %s)%s, %.0f ticks/s",
+            path,
+            replay.player,
+            replay.seed,
+            len(replay.ticks),
+            game.score,
+            recorded,
+            "" if recorded in (None, game.score) else " MISMATCH",
+            len(replay.ticks) / elapsed if elapsed else 0,
+        )
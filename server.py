@@ -1,19 +1,26 @@
 """Network Game Server."""
 import argparse
 import asyncio
+import base64
+import itertools
 import json
 import logging
+import os
 import os.path
 import random
-from collections import namedtuple
+import time
+from collections import deque, namedtuple
 from functools import reduce
 from operator import add
 
-import requests
-from requests import RequestException
 import websockets
 
+from agents import load_agent
 from game import Game
+from highscores import HighScores
+from protocol import ENCODINGS, Frames
+from replay import ReplayWriter
+from submitter import ScoreSubmitter
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -24,61 +31,291 @@ wslogger.setLevel(logging.WARN)
 logger = logging.getLogger("Server")
 logger.setLevel(logging.INFO)
 
-Player = namedtuple("Player", ["name", "ws"])
-
-HIGHSCORE_FILE = "highscores.json"
-MAX_HIGHSCORES = 10
+Player = namedtuple("Player", ["name", "conn", "agent"], defaults=(None,))
+
+BOT_RESTART = 1  # seconds between the games of a house bot
+MAX_REPLAYS = 10000  # replay files kept, the oldest are removed
+
+OUTBOX_SIZE = 8  # frames queued for a viewer before stale ones are dropped
+MAX_DROPPED = 100  # frames dropped in a row before a viewer is considered stuck
+
+
+class Connection:
+    """A client websocket and the encoding it negotiated on join."""
+
+    def __init__(self, ws, delta=False, encoding="json"):
+        self.ws = ws
+        self.delta = delta
+        self.encoding = encoding
+        self.resync = True  # next frame must be a keyframe, as is the first one
+        self.dropped = 0  # frames dropped since the last one was sent
+        self.closed = False
+
+        self._outbox = deque()  # (message, droppable) waiting to be sent
+        self._pending = asyncio.Event()
+        self._writer = None
+
+    def encode(self, message):
+        """A string as is, or the right encoding of a tick's Frames."""
+        if isinstance(message, Frames):
+            message = message.get(self.delta, self.resync, self.encoding)
+            self.resync = False
+        return message
+
+    async def send(self, message):
+        """Send a message, waiting for it to be written."""
+        await self.ws.send(self.encode(message))
+
+    def post(self, message, droppable=True):
+        """Queue a message without waiting, dropping stale frames when lagging."""
+        if self.closed:
+            return
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write())
+
+        if droppable and len(self._outbox) >= OUTBOX_SIZE:
+            kept = deque(item for item in self._outbox if not item[1])
+            self.dropped += len(self._outbox) - len(kept)
+            self._outbox = kept
+            self.resync = True  # delta frames no longer apply
+            if self.dropped > MAX_DROPPED:
+                logger.warning("Disconnecting stuck client %s", self.ws.remote_address)
+                self.stop()
+                asyncio.ensure_future(self.ws.close())
+                return
+
+        self._outbox.append((self.encode(message), droppable))
+        self._pending.set()
+
+    async def _write(self):
+        try:
+            while True:
+                await self._pending.wait()
+                while self._outbox:
+                    message, _ = self._outbox.popleft()
+                    await self.ws.send(message)
+                    self.dropped = 0
+                self._pending.clear()
+        except websockets.exceptions.ConnectionClosed:
+            self.closed = True
+            self._outbox.clear()
+
+    def stop(self):
+        """Stop sending queued messages."""
+        self.closed = True
+        self._outbox.clear()
+        if self._writer:
+            self._writer.cancel()
+
+    async def close(self):
+        await self.ws.close()
+
+
+class GameSession:
+    """A single game, played by one player and watched by its own viewers."""
+
+    def __init__(self, game_id, player, game):
+        self.id = game_id
+        self.player = player
+        self.game = game
+        self.viewers = set()
+        self.task = None
+        self.seq = 0  # tick sequence number, for delta encoding
+        self.version = None  # game version of the last keyframe
+        self.next_pieces = None  # (kind, rotation) of the next pieces last sent
+        self.acted = asyncio.Event()  # player sent its move for the current tick
+        self.replay = None  # ReplayWriter recording the game
+
+    async def wait_action(self, deadline=None):
+        """Wait for the player's move, or until the deadline (seconds) expires."""
+        try:
+            await asyncio.wait_for(self.acted.wait(), deadline)
+        except asyncio.TimeoutError:
+            logger.debug("<%s> missed the tick deadline", self.player.name)
+        self.acted.clear()
+
+    def frames(self, state):
+        """Wrap a tick's state, deciding whether it is a keyframe."""
+        self.seq += 1
+        keyframe = self.game.version != self.version
+        self.version = self.game.version
+        next_pieces = tuple((n.name, n.rotation) for n in self.game.next_pieces)
+        spawned = next_pieces != self.next_pieces
+        self.next_pieces = next_pieces
+        return Frames(state, self.seq, keyframe, self.game, spawned)
 
 
 class GameServer:
-    """Network Game Server."""
-
-    def __init__(self, level, timeout, seed=0, grading=None):
+    """Network Game Server, running many independent games at once."""
+
+    def __init__(
+        self,
+        level,
+        timeout,
+        seed=0,
+        grading=None,
+        lockstep=False,
+        tick_deadline=None,
+        replays=None,
+        grading_batch=1,
+        highscores=None,
+        max_replays=MAX_REPLAYS,
+    ):
         self.seed = seed
-        self.game = Game()
-        self.players = asyncio.Queue()
-        self.viewers = set()
-        self.current_player = None
-        self.grading = grading
+        self.replays = replays  # directory games are recorded to
+        self.max_replays = max_replays  # replay files kept, 0 for all
+        self._recorded = deque()  # replay files, oldest first
+        if replays and os.path.isdir(replays):
+            self._recorded.extend(
+                os.path.join(replays, name)
+                for name in sorted(os.listdir(replays))
+                if name.endswith(".replay")
+            )
+        self.lockstep = lockstep  # next tick as soon as the player moves
+        self.tick_deadline = tick_deadline  # seconds to wait for a move in lockstep
+        self.games = {}  # game id -> GameSession
+        self.viewers = set()  # viewers following the most recent game
+        self.submitter = (
+            ScoreSubmitter(grading, batch_size=grading_batch) if grading else None
+        )
         self._level = level  # game level
         self._timeout = timeout  # timeout for game
+        self._game_ids = itertools.count(1)
+        self._sessions = {}  # player websocket -> GameSession
+        self._connections = {}  # websocket -> Connection
+        self._featured = None  # game followed by self.viewers
+        self._info = Game().info()  # static information sent before any game starts
 
-        self._highscores = []
-        if os.path.isfile(HIGHSCORE_FILE):
-            with open(HIGHSCORE_FILE, "r") as infile:
-                self._highscores = json.load(infile)
-                print(self._highscores)
+        self.highscores = HighScores() if highscores is None else highscores
+        print(self.highscores.top())
 
-    def save_highscores(self, score):
-        """Update highscores, storing to file."""
+    def save_highscores(self, player_name, score):
+        """Update highscores, storing to file in the background."""
         logger.debug("Save highscores")
         logger.info(
             "%s FINAL SCORE <%s>",
-            self.current_player.name,
+            player_name,
             score,
         )
 
-        self._highscores.append((self.current_player.name, score))
-        self._highscores = sorted(self._highscores, key=lambda s: s[1], reverse=True)[
-            :MAX_HIGHSCORES
-        ]
+        self.highscores.add(player_name, score)
+
+        print(self.highscores.top())
 
-        print(self._highscores)
+    def audience(self, session):
+        """Viewers watching a game."""
+        if session is self._featured:
+            return session.viewers | self.viewers
+        return session.viewers
 
-        with open(HIGHSCORE_FILE, "w") as outfile:
-            json.dump(self._highscores, outfile)
+    def games_info(self):
+        """Summary of the games currently running."""
+        return [
+            {"game": session.id, "player": session.player.name}
+            for session in self.games.values()
+        ]
+
+    def broadcast(self, session, message, droppable=True):
+        """Queue a message for the viewers of a game, never waiting on them."""
+        for client in self.audience(session):
+            client.post(message, droppable)
 
-    async def send_info(self, game_info, highscores=False):
+    async def send_info(self, session, game_info, highscores=False):
         """Send game info to viewer and player."""
         if highscores:
-            game_info["highscores"] = self._highscores
-            game_info["player"] = self.current_player.name
-
-        if self.viewers:
-            await asyncio.wait(
-                [client.send(json.dumps(game_info)) for client in self.viewers]
-            )
-        await self.current_player.ws.send(json.dumps(game_info))
+            game_info["highscores"] = self.highscores.top()
+            game_info["player"] = session.player.name
+
+        message = json.dumps(game_info)
+        self.broadcast(session, message, droppable=False)
+        if session.player.conn:
+            await session.player.conn.send(message)
+
+    def start_game(self, player):
+        """Create a game for a player and run it in its own task."""
+        game_id = next(self._game_ids)
+        seed = self.seed if self.seed > 0 else random.randrange(2 ** 63)
+        rng = random.Random(seed)
+
+        replay = None
+        if self.replays:
+            name = f"{int(time.time() * 1000)}-{game_id}.replay"
+            path = os.path.join(self.replays, name)
+            replay = ReplayWriter(path, seed, player.name, rng)
+            rng = replay.rng
+            self._recorded.append(path)
+            self.prune_replays()
+
+        session = GameSession(game_id, player, Game(rng=rng))
+        if replay:
+            replay.start(session.game)
+            session.replay = replay
+
+        self.games[session.id] = session
+        if player.conn:
+            self._sessions[player.conn.ws] = session
+        self.feature(session)
+
+        session.task = asyncio.ensure_future(self.play(session))
+        return session
+
+    def prune_replays(self):
+        """Remove the oldest replay files beyond max_replays."""
+        while self.max_replays and len(self._recorded) > self.max_replays:
+            path = self._recorded.popleft()
+            try:
+                os.remove(path)
+            except OSError as err:
+                logger.warning("Could not remove replay: %s", err)
+
+    def feature(self, session):
+        """Make viewers of the latest game follow another one."""
+        if session is not self._featured:
+            for conn in self.viewers:
+                conn.resync = True  # deltas of another game do not apply
+        self._featured = session
+
+    def end_game(self, session):
+        """Forget a finished game."""
+        del self.games[session.id]
+        if session.player.conn:
+            self._sessions.pop(session.player.conn.ws, None)
+        if session is self._featured:
+            self.feature(self.games[max(self.games)] if self.games else None)
+
+    def keypress(self, session, data):
+        """Queue the keys of a key command.
+
+        "key" may hold several keys, applied in order within the next tick, as
+        may a "keys" list. A "target" {"rotation": r, "x": x} is turned into the
+        keys that place the piece there, targets it cannot reach are ignored."""
+        keys = list(data.get("key", "")) + list(data.get("keys", []))
+        if "target" in data:
+            target = data["target"]
+            target_keys = None
+            if isinstance(target, dict):
+                target_keys = session.game.target_keys(
+                    target.get("rotation"), target.get("x")
+                )
+            if target_keys is None:
+                logger.debug("<%s> sent an unreachable target", session.player.name)
+                return
+            keys += target_keys
+
+        for key in keys:
+            if not session.game.keypress(key):
+                logger.debug("<%s> sent too many keys", session.player.name)
+                break
+
+    async def house_bot(self, name, spec):
+        """Keep an in-process agent playing, one game after the other."""
+        while True:
+            session = self.start_game(Player(name, None, load_agent(spec)))
+            try:
+                await session.task
+            except Exception:
+                logger.exception("House bot <%s> failed", name)
+            await asyncio.sleep(BOT_RESTART)
 
     async def incomming_handler(self, websocket, path):
         """Process new clients arriving at the server."""
@@ -88,87 +325,117 @@ class GameServer:
                 if not "cmd" in data:
                     continue
                 if data["cmd"] == "join":
+                    encoding = data.get("encoding", "json")
+                    if encoding not in ENCODINGS:
+                        logger.warning("Unknown encoding <%s>, using json", encoding)
+                        encoding = "json"
+                    conn = Connection(websocket, bool(data.get("delta")), encoding)
+                    self._connections[websocket] = conn
+
+                    game_info = dict(self._info)
                     if path == "/player":
                         logger.info("<%s> has joined", data["name"])
-                        await self.players.put(Player(data["name"], websocket))
+                        session = self.start_game(Player(data["name"], conn))
+                        game_info = session.game.info()
+                        game_info["game"] = session.id
 
                     if path == "/viewer":
-                        logger.info("Viewer connected")
-                        self.viewers.add(websocket)
+                        session = self.games.get(data.get("game"))
+                        if session:
+                            logger.info("Viewer connected to game <%s>", session.id)
+                            session.viewers.add(conn)
+                            game_info = session.game.info()
+                            game_info["game"] = session.id
+                        else:
+                            logger.info("Viewer connected")
+                            self.viewers.add(conn)
+                        game_info["games"] = self.games_info()
 
-                    game_info = self.game.info()
                     await websocket.send(json.dumps(game_info))
 
-                if data["cmd"] == "key" and self.current_player.ws == websocket:
-                    logger.debug((self.current_player.name, data))
-                    if len(data["key"]) > 0:
-                        self.game.keypress(data["key"][0])
-                    else:
-                        self.game.keypress("")
-
-        except websockets.exceptions.ConnectionClosed as closed_reason:
-            logger.info("Client disconnected: %s", closed_reason)
-            if websocket in self.viewers:
-                self.viewers.remove(websocket)
-
-    async def mainloop(self):
-        """Main loop, runing the Game."""
-        while True:
-            logger.info("Waiting for player")
-            self.current_player = await self.players.get()
-
-            if self.current_player.ws.closed:
-                logger.error("<%s> disconnect while waiting", self.current_player.name)
-                continue
-
-            try:
-                logger.info("Starting game for <%s>", self.current_player.name)
-                if self.seed > 0:
-                    random.seed(self.seed)
+                if data["cmd"] == "resync" and websocket in self._connections:
+                    self._connections[websocket].resync = True
 
-                self.game = Game()
+                session = self._sessions.get(websocket)
+                if data["cmd"] == "key" and session:
+                    logger.debug((session.player.name, data))
+                    self.keypress(session, data)
+                    session.acted.set()
 
-                game_info = await self.game.loop()
-                await self.send_info(game_info)
+                if data["cmd"] == "noop" and session:
+                    session.acted.set()
 
-                if self.grading:
-                    game_record = dict()
-                    game_record["player"] = self.current_player.name
-
-                while self.game.running:
-                    state = await self.game.loop()
-                    state["player"] = self.current_player.name
-
-                    state = json.dumps(state)
-
-                    await self.current_player.ws.send(state)
-                    if self.viewers:
-                        await asyncio.wait(
-                            [client.send(state) for client in self.viewers]
-                        )
-                self.save_highscores(self.game.score)
-
-                game_info = self.game.info()
-                game_info["player"] = self.current_player.name
-
-                await self.send_info(game_info, highscores=True)
-                await self.current_player.ws.close()
-                self.current_player = None
-
-            except websockets.exceptions.ConnectionClosed:
-                self.current_player = None
-            finally:
-                try:
-                    if self.grading:
-                        game_record["score"] = self.game.score
-                        requests.post(self.grading, json=game_record, timeout=2)
-                except RequestException as err:
-                    logger.error(err)
-                    logger.warning("Could not save score to server")
+        except websockets.exceptions.ConnectionClosed as closed_reason:
+            logger.info("Client disconnected: %s", closed_reason)
+        finally:
+            if websocket in self._sessions:
+                self._sessions[websocket].acted.set()  # don't wait for a gone player
+            conn = self._connections.pop(websocket, None)
+            if conn:
+                conn.stop()
+            self.viewers.discard(conn)
+            for session in self.games.values():
+                session.viewers.discard(conn)
+
+    async def play(self, session):
+        """Run a game until it is over or the player leaves."""
+        player = session.player
+        game = session.game
+        try:
+            logger.info("Starting game <%s> for <%s>", session.id, player.name)
+
+            while game.running:
+                if self.lockstep:
+                    state = game.step()
+                else:
+                    state = await game.loop()
+                state["player"] = player.name
+                if session.replay:
+                    session.replay.tick(state["applied"])
+
+                frames = session.frames(state)
+
+                if player.agent:
+                    self.broadcast(session, frames)
+                    keys = player.agent.decide(state) or ""
+                    self.keypress(session, {"keys": list(keys)})
+                    session.acted.set()
+                    await asyncio.sleep(0)  # lockstep bots must not starve the server
+                    continue
 
-                if self.current_player:
-                    logger.info("Disconnecting <%s>", self.current_player.name)
-                    await self.current_player.ws.close()
+                await player.conn.send(frames)
+                self.broadcast(session, frames)
+
+                if self.lockstep:
+                    await session.wait_action(self.tick_deadline)
+            if not self.lockstep:
+                logger.info("Game <%s> ticks: %s", session.id, game.scheduler.stats())
+            if player.agent:  # house bots would crowd players out of the table
+                logger.info("%s FINAL SCORE <%s>", player.name, game.score)
+            else:
+                self.save_highscores(player.name, game.score)
+
+            game_info = game.info()
+            game_info["player"] = player.name
+
+            await self.send_info(session, game_info, highscores=True)
+
+        except websockets.exceptions.ConnectionClosed:
+            logger.info("<%s> left game <%s>", player.name, session.id)
+        finally:
+            self.end_game(session)
+            if session.replay:
+                session.replay.close(game)
+            if player.conn:
+                if self.submitter:
+                    record = {"player": player.name, "score": game.score}
+                    if session.replay:
+                        with open(session.replay.path, "rb") as infile:
+                            record["replay"] = base64.b64encode(infile.read()).decode()
+                    self.submitter.submit(record)
+
+                logger.info("Disconnecting <%s>", player.name)
+                await player.conn.close()
 
 
 if __name__ == "__main__":
@@ -181,15 +448,64 @@ if __name__ == "__main__":
         help="url of grading server",
         default="http://atnog-tetriscores.av.it.pt/game",
     )
+    parser.add_argument(
+        "--grading-batch",
+        help="records sent at once, for grading servers that accept lists",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--lockstep",
+        help="advance each game as soon as its player sends a key (or noop)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tick-deadline",
+        help="seconds to wait for the player's key in lockstep mode",
+        type=float,
+    )
+    parser.add_argument(
+        "--bot",
+        help="house bot playing in the server process, as NAME=module:name",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--replays",
+        help="directory to record games to, empty to disable",
+        default="replays",
+    )
+    parser.add_argument(
+        "--max-replays",
+        help="replay files kept, the oldest are removed (0 to keep all)",
+        type=int,
+        default=MAX_REPLAYS,
+    )
     args = parser.parse_args()
 
-    g = GameServer(0, -1, args.seed, args.grading_server)
-
-    game_loop_task = asyncio.ensure_future(g.mainloop())
+    if args.replays:
+        os.makedirs(args.replays, exist_ok=True)
+
+    g = GameServer(
+        0,
+        -1,
+        args.seed,
+        args.grading_server,
+        args.lockstep,
+        args.tick_deadline,
+        args.replays,
+        args.grading_batch,
+        max_replays=args.max_replays,
+    )
+    if g.submitter:
+        g.submitter.start()
 
     logger.info("Listenning @ %s:%s", args.bind, args.port)
     websocket_server = websockets.serve(g.incomming_handler, args.bind, args.port)
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.gather(websocket_server, game_loop_task))
-    loop.close()
+    loop.run_until_complete(websocket_server)
+    for bot in args.bot:
+        name, _, spec = bot.partition("=")
+        asyncio.ensure_future(g.house_bot(name, spec))
+    loop.run_forever()
@@ -1,3 +1,4 @@
+from collections import namedtuple
 from common import Dimensions
 import random
 
@@ -119,36 +120,74 @@ T = "T", [
 ]
 
 
+Rotation = namedtuple("Rotation", ["cells", "box", "rows", "bottoms"])
+"""Compiled rotation: cell offsets, bounding box (min_x, min_y, max_x, max_y),
+(dy, mask) rows and (dx, dy) of the lowest cell in each column."""
+
+
+def compile_rotation(lines):
+    cells = tuple(
+        (x, y) for y, line in enumerate(lines) for x, pos in enumerate(line) if pos == "1"
+    )
+    xs = [x for x, _ in cells]
+    ys = [y for _, y in cells]
+    rows = {}
+    bottoms = {}
+    for x, y in cells:
+        rows[y] = rows.get(y, 0) | 1 << x
+        bottoms[x] = max(bottoms.get(x, y), y)
+    return Rotation(
+        cells,
+        (min(xs), min(ys), max(xs), max(ys)),
+        tuple(sorted(rows.items())),
+        tuple(sorted(bottoms.items())),
+    )
+
+
+PLANS = dict([S, Z, I, O, J, T, L])
+KINDS = tuple(PLANS)  # same order as SHAPES, random.choice over either yields the same piece
+ROTATIONS = {
+    name: tuple(compile_rotation(lines) for lines in plan) for name, plan in PLANS.items()
+}
+
+
 class Shape:
-    def __init__(self, plan) -> None:
-        self.name, self.plan = plan
-        self.rotation = 0
-        self.dimensions = Dimensions(5, 5)
+    __slots__ = ("name", "rotation", "_x", "_y")
+
+    dimensions = Dimensions(5, 5)
 
-        self._x = 0
-        self._y = 0
-        self.rotate()
+    def __init__(self, plan, rotation=None, x=0, y=0) -> None:
+        self.name = plan[0] if isinstance(plan, tuple) else plan
+        if rotation is None:
+            rotation = 1 % len(ROTATIONS[self.name])  # pieces always spawned rotated once
+        self.rotation = rotation
+        self._x = int(x)
+        self._y = int(y)
+
+    @property
+    def plan(self):
+        return PLANS[self.name]
+
+    @property
+    def shape(self):
+        """Compiled table of the current rotation."""
+        return ROTATIONS[self.name][self.rotation]
+
+    @property
+    def positions(self):
+        x, y = self._x, self._y
+        return [(x + cx, y + cy) for cx, cy in ROTATIONS[self.name][self.rotation].cells]
 
     def set_pos(self, x, y):
-        x = int(x)
-        y = int(y)
-        self.positions = [
-            (cx + x - self._x, cy + y - self._y) for cx, cy in self.positions
-        ]
-        self._x = x
-        self._y = y
+        self._x = int(x)
+        self._y = int(y)
 
     def rotate(self, step=1):
-        self.rotation = (self.rotation + step) % len(self.plan)
-        self.positions = [
-            (self._x + x, self._y + y)
-            for y, line in enumerate(self.plan[self.rotation])
-            for x, pos in enumerate(line)
-            if pos == "1"
-        ]
+        self.rotation = (self.rotation + step) % len(ROTATIONS[self.name])
 
     def translate(self, x, y):
-        self.set_pos(self._x + x, self._y + y)
+        self._x += x
+        self._y += y
 
     @property
     def x(self):
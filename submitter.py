@@ -0,0 +1,105 @@
+"""Background submission of game scores to the grading server."""
+import asyncio
+import json
+import logging
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests import RequestException
+
+from common import atomic_write
+
+logger = logging.getLogger("Submitter")
+logger.setLevel(logging.INFO)
+
+SPOOL_FILE = "grading_spool.jsonl"
+SHAPE_ERRORS = (400, 413, 415, 422)  # server does not take a batch as sent
+MIN_BACKOFF = 1  # seconds
+MAX_BACKOFF = 300
+
+
+class ScoreSubmitter:
+    """Send game records to the grading server without blocking the event loop.
+
+    Records are kept in a spool file until the grading server acknowledges
+    them, so they survive restarts. Pending records are sent one at a time,
+    or up to batch_size at once to servers that take lists, retrying with
+    exponential backoff while the server is unreachable or failing. A server
+    that rejects a batch as malformed gets single records from then on.
+    """
+
+    def __init__(self, url, spool=SPOOL_FILE, batch_size=1):
+        self.url = url
+        self.spool = spool
+        self._pending = []
+        if os.path.isfile(spool):
+            with open(spool, "r") as infile:
+                self._pending = [json.loads(line) for line in infile if line.strip()]
+            logger.info("%s records waiting to be submitted", len(self._pending))
+
+        self._io = ThreadPoolExecutor(max_workers=1)  # spool writes stay in order
+        self._http = ThreadPoolExecutor(max_workers=1)
+        self._wakeup = None
+        self._task = None
+        self._batch_size = batch_size
+
+    def submit(self, record):
+        """Queue a game record for submission."""
+        self._pending.append(record)
+        self._io.submit(self._append, record)
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        """Start sending records, including the ones left from previous runs."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self.run())
+
+    def _append(self, record):
+        with open(self.spool, "a") as outfile:
+            outfile.write(json.dumps(record) + "\n")
+
+    def _save(self, records):
+        atomic_write(self.spool, "".join(json.dumps(r) + "\n" for r in records))
+
+    def _post(self, batch):
+        response = requests.post(
+            self.url, json=batch if len(batch) > 1 else batch[0], timeout=10
+        )
+        response.raise_for_status()
+
+    async def run(self):
+        """Send pending records until none are left, then wait for more."""
+        loop = asyncio.get_event_loop()
+        backoff = MIN_BACKOFF
+        if self._pending:
+            self._wakeup.set()
+
+        while True:
+            await self._wakeup.wait()
+            batch = self._pending[: self._batch_size]
+            try:
+                await loop.run_in_executor(self._http, self._post, batch)
+            except RequestException as err:
+                response = getattr(err, "response", None)
+                status = response.status_code if response is not None else None
+                if status in SHAPE_ERRORS and len(batch) > 1:
+                    logger.warning(
+                        "Batch refused, sending records one at a time: %s", err
+                    )
+                    self._batch_size = 1
+                    continue
+                if status is None or status >= 500:
+                    logger.warning("Could not save scores to server: %s", err)
+                    await asyncio.sleep(backoff)
+                    backoff = min(2 * backoff, MAX_BACKOFF)
+                    continue
+                logger.error("Grading server rejected %s records: %s", len(batch), err)
+
+            backoff = MIN_BACKOFF
+            del self._pending[: len(batch)]
+            await loop.run_in_executor(self._io, self._save, list(self._pending))
+            if not self._pending:
+                self._wakeup.clear()
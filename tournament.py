@@ -0,0 +1,127 @@
+"""Headless tournament between agents.
+
+Every agent plays one game per seed; games with the same seed get the same
+pieces. Games run in a pool of processes and the results are written to a
+JSON file, per game and summarised per agent.
+
+    $ python3 tournament.py agents:drop agents:RandomAgent --seeds 1-100 --workers 8
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from agents import load_agent
+from game import Game
+
+logger = logging.getLogger("Tournament")
+logger.setLevel(logging.INFO)
+
+
+def play(spec, seed, max_ticks=None):
+    """Play a game with a fresh agent, return its record."""
+    logging.getLogger("Game").setLevel(logging.WARNING)
+    random.seed(seed)  # for agents using the random module
+    agent = load_agent(spec, seed)
+    game = Game(rng=random.Random(seed))
+
+    keys = None
+    ticks = 0
+    while game.running and (max_ticks is None or ticks < max_ticks):
+        state = game.step(keys)
+        state["player"] = spec
+        ticks += 1
+        keys = agent.decide(state)
+
+    return {
+        "agent": spec,
+        "seed": seed,
+        "score": game.score,
+        "lines": game.lines,
+        "ticks": ticks,
+        "finished": not game.running,
+    }
+
+
+def summary(records):
+    """Score, lines and game length statistics of an agent's games."""
+    scores = [r["score"] for r in records]
+    return {
+        "games": len(records),
+        "score_mean": statistics.mean(scores),
+        "score_median": statistics.median(scores),
+        "score_stdev": statistics.pstdev(scores),
+        "score_min": min(scores),
+        "score_max": max(scores),
+        "score_quartiles": statistics.quantiles(scores, n=4) if len(scores) > 1 else scores * 3,
+        "lines_mean": statistics.mean(r["lines"] for r in records),
+        "lines_total": sum(r["lines"] for r in records),
+        "ticks_mean": statistics.mean(r["ticks"] for r in records),
+    }
+
+
+def run(specs, seeds, workers=None, max_ticks=None):
+    """Play every agent against every seed, return the per-game records."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(play, spec, seed, max_ticks) for spec in specs for seed in seeds
+        ]
+        return [future.result() for future in futures]
+
+
+def parse_seeds(text):
+    """Seeds as "1-100", "1,5,9" or a mix of both."""
+    seeds = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        seeds.extend(range(int(first), int(last or first) + 1))
+    return seeds
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("agents", help="agents as module:name", nargs="+")
+    parser.add_argument("--seeds", help="seeds, e.g. 1-100 or 1,5,9", default="1-100")
+    parser.add_argument(
+        "--workers", help="processes to use", type=int, default=os.cpu_count()
+    )
+    parser.add_argument("--max-ticks", help="stop games after this many ticks", type=int)
+    parser.add_argument("--output", help="results file", default="tournament.json")
+    args = parser.parse_args()
+
+    seeds = parse_seeds(args.seeds)
+    for spec in args.agents:
+        load_agent(spec)  # fail early on a wrong reference
+
+    start = time.time()
+    records = run(args.agents, seeds, args.workers, args.max_ticks)
+    elapsed = time.time() - start
+
+    results = {
+        "seeds": seeds,
+        "elapsed": elapsed,
+        "agents": {
+            spec: summary([r for r in records if r["agent"] == spec])
+            for spec in args.agents
+        },
+        "games": records,
+    }
+    with open(args.output, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+
+    for spec, stats in results["agents"].items():
+        logger.info(
+            "%s: score %.2f ± %.2f, lines %.2f, %.0f ticks",
+            spec,
+            stats["score_mean"],
+            stats["score_stdev"],
+            stats["lines_mean"],
+            stats["ticks_mean"],
+        )
+    logger.info("%s games in %.1fs, results in %s", len(records), elapsed, args.output)
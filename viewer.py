@@ -10,6 +10,7 @@ import websockets
 import pygame
 
 from common import Dimensions
+from protocol import DeltaDecoder, decode
 
 logging.basicConfig(level=logging.DEBUG)
 logger_websockets = logging.getLogger("websockets")
@@ -21,6 +22,9 @@ logger.setLevel(logging.DEBUG)
 BLOCK_SIDE = 30
 BLOCK_SIZE = BLOCK_SIDE, BLOCK_SIDE
 
+FPS = 30  # frames rendered per second
+HIGHSCORES_TTL = 60  # seconds global highscores are used before revalidating
+
 COLORS = {
     "white": (255, 255, 255),
     "red": (255, 0, 0),
@@ -33,159 +37,278 @@ COLORS = {
 }
 
 
-async def messages_handler(websocket_path, queue):
-    """Handles server side messages, putting them into a queue."""
+async def messages_handler(websocket_path, updates, game=None):
+    """Handles server side messages, putting them into updates."""
     async with websockets.connect(websocket_path) as websocket:
-        await websocket.send(json.dumps({"cmd": "join"}))
+        join = {"cmd": "join", "delta": True, "encoding": "binary"}
+        if game:
+            join["game"] = game  # watch a given game instead of the latest one
+        await websocket.send(json.dumps(join))
 
+        decoder = DeltaDecoder()
         while True:
-            update = await websocket.recv()
-            queue.put_nowait(update)
+            update = decoder.decode(decode(await websocket.recv()))
+            if update is None:
+                await websocket.send(json.dumps({"cmd": "resync"}))
+                continue
+            updates.put(update)
 
 
 def scale(pos):
-    """Scale positions according to gfx."""
-    x, y = pos
-    return int(x * BLOCK_SIDE / SCALE), int(y * BLOCK_SIDE / SCALE)
-
-
-def draw_info(surface, text, pos, color=(0, 0, 0), background=None):
-    """Creates text based surfaces for information display."""
-    myfont = pygame.font.Font(None, int(24 / SCALE))
-    textsurface = myfont.render(text, True, color, background)
-
+    """Scale positions according to gfx, on the same grid as the Renderer's cells."""
     x, y = pos
-    if x > surface.get_width():
-        pos = surface.get_width() - (textsurface.get_width() + 10), y
-    if y > surface.get_height():
-        pos = x, surface.get_height() - textsurface.get_height()
-
-    if background:
-        surface.blit(background, pos)
-    else:
-        erase = pygame.Surface(textsurface.get_size())
-        erase.fill(COLORS["grey"])
-
-    surface.blit(textsurface, pos)
-    return textsurface.get_width(), textsurface.get_height()
-
-
-async def main_loop(queue):
+    side = BLOCK_SIDE // SCALE
+    return x * side, y * side
+
+
+class Renderer:
+    """Draws frames on a window, redrawing only the cells and texts that changed.
+
+    A frame is a dict of cells, (x, y) in blocks -> color, and a dict of texts,
+    (x, y) in pixels -> (text, color). Texts placed beyond the right edge of the
+    window are aligned to it."""
+
+    def __init__(self, win, scale_factor=1):
+        self.win = win
+        self.side = BLOCK_SIDE // scale_factor
+        self.font = pygame.font.Font(None, int(24 / scale_factor))
+        self._tiles = {}  # color -> pre-rendered block
+        self._cells = {}  # cells on screen
+        self._texts = {}  # texts on screen, pos -> (text, color, rect)
+        self._dirty = []
+
+    def tile(self, color):
+        """A block of the given color, rendered once."""
+        if color not in self._tiles:
+            tile = pygame.Surface((self.side, self.side)).convert()
+            tile.fill(color)
+            self._tiles[color] = tile
+        return self._tiles[color]
+
+    def cell_rect(self, pos):
+        x, y = pos
+        return pygame.Rect(x * self.side, y * self.side, self.side, self.side)
+
+    def draw(self, cells, texts):
+        """Bring the window to the given frame."""
+        for pos in self._cells.keys() - cells.keys():
+            self._dirty.append(self.win.fill((0, 0, 0), self.cell_rect(pos)))
+
+        kept = {}
+        for pos, (text, color, rect) in self._texts.items():
+            if texts.get(pos) == (text, color):
+                kept[pos] = (text, color, rect)
+            else:
+                self._dirty.append(self.win.fill((0, 0, 0), rect))
+
+        for pos, color in cells.items():
+            if self._cells.get(pos) != color:
+                self._dirty.append(self.win.blit(self.tile(color), self.cell_rect(pos)))
+        self._cells = cells
+
+        for pos, (text, color) in texts.items():
+            if pos not in kept:
+                kept[pos] = (text, color, self.write(text, pos, color))
+        self._texts = kept
+
+    def write(self, text, pos, color):
+        surface = self.font.render(text, True, color)
+        x, y = pos
+        if x > self.win.get_width():
+            x = self.win.get_width() - (surface.get_width() + 10)
+        if y > self.win.get_height():
+            y = self.win.get_height() - surface.get_height()
+        rect = self.win.blit(surface, (x, y))
+        self._dirty.append(rect)
+        return rect
+
+    def flush(self):
+        """Update the parts of the display that were drawn on."""
+        if self._dirty:
+            pygame.display.update(self._dirty)
+            self._dirty = []
+
+
+def blocks(coordinates, color, x_offset=0, y_offset=0):
+    """Cells of a frame, for blocks of one color."""
+    return {(x + x_offset, y + y_offset): color for x, y in coordinates}
+
+
+class GlobalHighscores:
+    """Global highscores from the grading server, fetched in the background.
+
+    highscores holds the last [player, score] list received; refresh() starts
+    a conditional request (If-None-Match) once it is older than the TTL."""
+
+    def __init__(self, url, ttl=HIGHSCORES_TTL):
+        self.url = url
+        self.ttl = ttl
+        self.highscores = []
+        self._etag = None
+        self._fetched = None  # loop time of the last answer
+        self._task = None
+        self._session = requests.Session()
+
+    def refresh(self):
+        """Revalidate the highscores if stale, without waiting for it."""
+        loop = asyncio.get_event_loop()
+        if self._task and not self._task.done():
+            return
+        if self._fetched is not None and loop.time() - self._fetched < self.ttl:
+            return
+        self._task = asyncio.ensure_future(self._update())
+
+    async def _update(self):
+        loop = asyncio.get_event_loop()
+        try:
+            response = await loop.run_in_executor(None, self._get)
+            response.raise_for_status()
+            if response.status_code != 304:  # else still the same highscores
+                self.highscores = [
+                    [highscore["player"], highscore["score"]]
+                    for highscore in response.json()
+                ]
+                self._etag = response.headers.get("ETag")
+        except (requests.RequestException, ValueError) as err:
+            logger.warning("Could not fetch global highscores: %s", err)
+        self._fetched = loop.time()  # failures are retried after the TTL too
+
+    def _get(self):
+        headers = {"If-None-Match": self._etag} if self._etag else {}
+        return self._session.get(self.url, headers=headers, timeout=10)
+
+
+class Updates:
+    """Updates from the server waiting to be rendered.
+
+    The first one, the game information, is kept for info(). After it only
+    the newest highscores state and the newest state that followed it are
+    kept, so a viewer far behind skips states but never the end of a game."""
+
+    def __init__(self):
+        self._info = asyncio.get_event_loop().create_future()
+        self.highscores = None
+        self.state = None
+
+    def put(self, update):
+        if not self._info.done():
+            self._info.set_result(update)
+        elif "highscores" in update:
+            self.highscores, self.state = update, None
+        else:
+            self.state = update
+
+    async def info(self):
+        return await self._info
+
+    def latest(self):
+        """The highscores state and the newest state since the last call."""
+        highscores, state = self.highscores, self.state
+        self.highscores = self.state = None
+        return highscores, state
+
+
+async def main_loop(updates, fps=FPS):
     """Processes events from server and display's."""
     win = pygame.display.set_mode((600 // SCALE, 1000 // SCALE))
     pygame.display.set_caption("Tetris")
+    renderer = Renderer(win, SCALE)
 
     logging.info("Waiting for map information from server")
-    state = await queue.get()  # first state message includes map information
+    state = await updates.info()  # first state message includes map information
     logging.debug("Initial game status: %s", state)
-    newgame_json = json.loads(state)
+    newgame_json = state
     player_name = ""
 
     win.fill((0, 0, 0))
-
-    def draw_blocks(coordinates, color, x_offset=0, y_offset=0):
-        for x, y in coordinates:
-            pygame.draw.rect(
-                win,
-                color,
-                (
-                    (x + x_offset) * BLOCK_SIDE / SCALE,
-                    (y + y_offset) * BLOCK_SIDE / SCALE,
-                    BLOCK_SIDE / SCALE,
-                    BLOCK_SIDE / SCALE,
-                ),
-                0,
-            )
+    pygame.display.update()
 
     dimensions = Dimensions(*newgame_json["dimensions"])
 
-    draw_blocks(newgame_json["grid"], COLORS["blue"])
+    grid = blocks(newgame_json["grid"], COLORS["blue"])
+    renderer.draw(grid, {})
 
-    game_speed = newgame_json["game_speed"]
+    if GLOBAL_HIGHSCORES:
+        GLOBAL_HIGHSCORES.refresh()  # ready before the first game ends
 
+    loop = asyncio.get_event_loop()
+    next_frame = loop.time()
+    pending = None  # newest state, waiting for the highscores to be shown
     while True:
-        pygame.display.update()
+        renderer.flush()
 
         pygame.event.pump()
         if pygame.key.get_pressed()[pygame.K_ESCAPE]:
             asyncio.get_event_loop().stop()
 
-        try:
-            state = json.loads(queue.get_nowait())
-            if "score" in state:
-                score = state["score"]
-            if "player" in state:
-                player_name = state["player"]
-
-            if "game_speed" in state:
-                game_speed = state["game_speed"]
-
-            win.fill((0, 0, 0))
-
-            if "highscores" in state:
-                logging.debug("Final game status: %s", state)
-
-                if GLOBAL_HIGHSCORES:
-                    print("FUCK")
-                    highscores = [
-                        [highscore["player"], highscore["score"]]
-                        for highscore in requests.get(GLOBAL_HIGHSCORES).json()
-                    ]
-                    state["highscores"].extend(highscores)
-                    state["highscores"].sort(key=lambda h: h[1], reverse=True)
-                    state["highscores"] = state["highscores"][:9]
-                    state["highscores"].append([player_name, score])
-                    state["highscores"].sort(key=lambda h: h[1], reverse=True)
-
-                draw_info(win, "HIGHSCORES", scale((5, 5)), COLORS["blue"])
-                for idx, [name, sc] in enumerate(state["highscores"]):
-                    draw_info(
-                        win,
-                        f"{sc:>05}    {name:<24}",
-                        scale((5, 6 + idx)),
-                        COLORS["orange"]
-                        if [player_name, score] == [name, sc]
-                        else COLORS["white"],
-                    )
-                continue
-
-            draw_blocks(newgame_json["grid"], COLORS["blue"])
-
-            draw_blocks(state["game"], COLORS["red"])
-
-            if state["piece"]:
-                draw_blocks(state["piece"], COLORS["green"])
+        # render at a steady rate whatever the rate of updates, newest state only
+        now = loop.time()
+        next_frame = max(next_frame + 1.0 / fps, now)
+        await asyncio.sleep(next_frame - now)
+
+        highscores, newest = updates.latest()
+        if highscores:
+            state, pending = highscores, newest  # show the highscores for a frame
+        else:
+            state, pending = newest or pending, None
+        if state is None:
+            continue
 
-            yy = 1
-            for n, next_piece in enumerate(state["next_pieces"]):
-                draw_info(
-                    win, f"{n+1}º next:", scale((dimensions.x + 1, yy)), COLORS["white"]
+        if "score" in state:
+            score = state["score"]
+        if "player" in state:
+            player_name = state["player"]
+
+        if "highscores" in state:
+            logging.debug("Final game status: %s", state)
+
+            if GLOBAL_HIGHSCORES:
+                GLOBAL_HIGHSCORES.refresh()
+                state["highscores"].extend(GLOBAL_HIGHSCORES.highscores)
+                state["highscores"].sort(key=lambda h: h[1], reverse=True)
+                state["highscores"] = state["highscores"][:9]
+                state["highscores"].append([player_name, score])
+                state["highscores"].sort(key=lambda h: h[1], reverse=True)
+
+            texts = {scale((5, 5)): ("HIGHSCORES", COLORS["blue"])}
+            for idx, [name, sc] in enumerate(state["highscores"]):
+                texts[scale((5, 6 + idx))] = (
+                    f"{sc:>05}    {name:<24}",
+                    COLORS["orange"]
+                    if [player_name, score] == [name, sc]
+                    else COLORS["white"],
                 )
+            renderer.draw({}, texts)
+            continue
 
-                draw_blocks(
+        cells = dict(grid)
+        cells.update(blocks(state["game"], COLORS["red"]))
+        if state["piece"]:
+            cells.update(blocks(state["piece"], COLORS["green"]))
+
+        texts = {}
+        yy = 1
+        for n, next_piece in enumerate(state["next_pieces"]):
+            texts[scale((dimensions.x + 1, yy))] = (f"{n+1}º next:", COLORS["white"])
+            cells.update(
+                blocks(
                     next_piece,
                     COLORS["pink"],
                     x_offset=dimensions.x + 2,
                     y_offset=yy + 1,
                 )
-                yy += 6
-
-            draw_info(
-                win,
-                f"{player_name}",
-                scale((dimensions.x + 1, dimensions.y-1)),
-                COLORS["white"],
-            )
-            draw_info(
-                win,
-                f"SCORE: {score}",
-                scale((dimensions.x + 1, dimensions.y)),
-                COLORS["white"],
             )
+            yy += 6
 
-        except asyncio.queues.QueueEmpty:
-            await asyncio.sleep(1.0 / game_speed)
-            continue
+        texts[scale((dimensions.x + 1, dimensions.y - 1))] = (
+            f"{player_name}",
+            COLORS["white"],
+        )
+        texts[scale((dimensions.x + 1, dimensions.y))] = (
+            f"SCORE: {score}",
+            COLORS["white"],
+        )
+        renderer.draw(cells, texts)
 
 
 if __name__ == "__main__":
@@ -198,6 +321,12 @@ if __name__ == "__main__":
         "--scale", help="reduce size of window by x times", type=int, default=1
     )
     parser.add_argument("--port", help="TCP port", type=int, default=PORT)
+    parser.add_argument(
+        "--fps", help="frames rendered per second", type=int, default=FPS
+    )
+    parser.add_argument(
+        "--game", help="id of the game to watch (default: latest)", type=int
+    )
     parser.add_argument(
         "--global-highscores",
         help="Retrieve global highscores",
@@ -212,12 +341,14 @@ if __name__ == "__main__":
     arguments = parser.parse_args()
     SCALE = arguments.scale
     GLOBAL_HIGHSCORES = (
-        arguments.grading_server if arguments.global_highscores else None
+        GlobalHighscores(arguments.grading_server)
+        if arguments.global_highscores
+        else None
     )
 
     LOOP = asyncio.get_event_loop()
     pygame.font.init()
-    q = asyncio.Queue()
+    q = Updates()
     PROGRAM_ICON = pygame.image.load("data/tetris_block.png")
     pygame.display.set_icon(PROGRAM_ICON)
 
@@ -225,7 +356,7 @@ if __name__ == "__main__":
 
     try:
         LOOP.run_until_complete(
-            asyncio.gather(messages_handler(ws_path, q), main_loop(q))
+            asyncio.gather(messages_handler(ws_path, q, arguments.game), main_loop(q, arguments.fps))
         )
     except RuntimeError as err:
         logger.error(err)
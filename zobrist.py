@@ -0,0 +1,89 @@
+"""Zobrist hashing of boards and a transposition cache for board evaluations.
+
+Every cell has a fixed random 64 bit key and a board hashes to the XOR of the
+keys of its filled cells, so placing a piece or clearing rows only needs the
+changed rows to be rehashed. Keys are drawn from a fixed seed and are the same
+in every process.
+"""
+import random
+from collections import OrderedDict
+
+MAX_WIDTH = 32  # walls included
+MAX_HEIGHT = 64
+
+_rng = random.Random(0x7E7215)
+# per row, per byte of the row mask, per byte value: XOR of the keys of its cells
+ROW_KEYS = []
+for _ in range(MAX_HEIGHT):
+    row = []
+    for _ in range(MAX_WIDTH // 8):
+        cells = [_rng.getrandbits(64) for _ in range(8)]
+        table = [0] * 256
+        for value in range(1, 256):
+            low = value & -value
+            table[value] = table[value ^ low] ^ cells[low.bit_length() - 1]
+        row.append(table)
+    ROW_KEYS.append(tuple(row))
+del _rng
+
+
+def hash_row(y, row):
+    """Hash of the filled cells of row y (a row mask)."""
+    keys = ROW_KEYS[y]
+    return (
+        keys[0][row & 0xFF]
+        ^ keys[1][row >> 8 & 0xFF]
+        ^ keys[2][row >> 16 & 0xFF]
+        ^ keys[3][row >> 24 & 0xFF]
+    )
+
+
+def hash_board(board):
+    """Hash of a board given as row masks, the floor row (last one) excluded."""
+    value = 0
+    for y in range(len(board) - 1):
+        value ^= hash_row(y, board[y])
+    return value
+
+
+def rehash(value, old, new, rows):
+    """Update a board hash for the rows that changed between two boards."""
+    for y in rows:
+        value ^= hash_row(y, old[y]) ^ hash_row(y, new[y])
+    return value
+
+
+class TranspositionCache:
+    """Bounded LRU cache of evaluations, keyed by (board hash, piece queue)."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0